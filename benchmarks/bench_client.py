@@ -0,0 +1,258 @@
+#!/bin/python3
+
+# Measures the API client paths of the examples against the mock API server
+# (mock_server.py), so that changes to paging, concurrency, retries and
+# decoding can be compared without an API key and without the variation of
+# the real API.
+#
+#   $ python benchmarks/bench_client.py --fields 5000 --latency 0.05
+#   $ python benchmarks/bench_client.py --scenario get_paged_data --rate 50
+#
+# The mock server runs in its own process, and each scenario is run in a
+# fresh process so that its peak memory use is its own. For each scenario
+# the requests made, requests per second, request latency percentiles and
+# peak resident memory are reported. Charts are not drawn unless --charts is
+# given, so that the processing scenarios measure decoding and reshaping.
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import numpy
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+FIELD_EXPLORER = os.path.join(BENCHMARKS, "..", "field-explorer-examples")
+GRAPHQL = os.path.join(BENCHMARKS, "..", "graphql-examples")
+COMMON = os.path.join(BENCHMARKS, "..", "common")
+
+SCENARIOS = ["fetch_all_results", "get_paged_data", "process_rainfall_data", "process_soil_data"]
+
+PLOT_FUNCTIONS = [
+    "box_plot_multiple_timeseries_by_freq",
+    "plot_multiple_timeseries_by_year",
+    "plot_timeseries",
+    "plot_stacked_bar_chart",
+    "plot_pie_chart",
+]
+
+
+def fetch_all_results(base_url, page_size, charts):
+    sys.path.insert(0, FIELD_EXPLORER)
+    import field_boundaries
+
+    url = f"{field_boundaries.BASE_URL}?lat=51.8&lon=-0.36&distance=5000"
+    results = field_boundaries.fetch_all_results(url, pageSize=page_size)
+    return len(results)
+
+
+def get_paged_data(base_url, page_size, charts):
+    sys.path.insert(0, GRAPHQL)
+    import field_examples
+
+    query = {
+        "query": """query BenchmarkFields($first: Int, $cursor: String) {
+            fields(first: $first, after: $cursor) {
+                id
+                cursor
+                location { centroid }
+            }
+        }""",
+        "variables": {"first": page_size, "cursor": None},
+    }
+    return sum(len(page) for page in field_examples.get_paged_field_data(query) if page)
+
+
+def process_rainfall_data(base_url, page_size, charts):
+    field_search = search_module(charts)
+    results = Counted(search_results(field_search, page_size))
+    field_search.process_rainfall_data(results)
+    return results.count
+
+
+def process_soil_data(base_url, page_size, charts):
+    field_search = search_module(charts)
+    results = Counted(search_results(field_search, page_size))
+    field_search.process_soil_data(results)
+    return results.count
+
+
+def search_module(charts):
+    sys.path.insert(0, FIELD_EXPLORER)
+    import field_search
+
+    if not charts:
+        for name in PLOT_FUNCTIONS:
+            setattr(field_search, name, lambda *args, **kwargs: None)
+    return field_search
+
+
+def search_results(field_search, page_size):
+    url = field_search.generate_search_query(
+        shape=field_search.circle_shape(field_search.SEARCH_CENTRE, field_search.SEARCH_RADIUS),
+        filter=field_search.SEARCH_FILTER_PROPERTIES,
+        select=field_search.SEARCH_SELECT_PROPERTIES,
+    )
+    # streamed, so that peak memory is that of processing the results
+    return field_search.stream_search_results(url, pageSize=page_size)
+
+
+class Counted:
+    """
+    Iterates over `items` once, counting them as they go.
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.count = 0
+
+    def __iter__(self):
+        for item in self.items:
+            self.count += 1
+            yield item
+
+
+def record_latencies(api_client):
+    """
+    Wrap api_client.request to record the time taken by each request
+    (including its retries), returning the list they are recorded in.
+    """
+    latencies = []
+    lock = threading.Lock()
+    request = api_client.request
+
+    def timed_request(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return request(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    api_client.request = timed_request
+    return latencies
+
+
+def run_scenario(name, base_url, page_size, charts):
+    """
+    Run one scenario in this process and return its measurements.
+    """
+    os.environ["API_BASE_URL"] = base_url
+    os.environ.setdefault("API_KEY", "benchmark")
+    os.environ.pop("API_CACHE", None)
+    if not charts:
+        os.environ.pop("PLOT_OUTPUT", None)
+
+    sys.path.insert(0, COMMON)
+    import api_client
+
+    api_client.configure(base_url=base_url, cache=False)
+    latencies = record_latencies(api_client)
+
+    start = time.perf_counter()
+    results = globals()[name](base_url, page_size, charts)
+    seconds = time.perf_counter() - start
+
+    percentiles = numpy.percentile(latencies, [50, 90, 99]) if latencies else [numpy.nan] * 3
+    return {
+        "scenario": name,
+        "results": results,
+        "requests": len(latencies),
+        "seconds": seconds,
+        "requests_per_second": len(latencies) / seconds if seconds else numpy.nan,
+        "p50": percentiles[0],
+        "p90": percentiles[1],
+        "p99": percentiles[2],
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def start_mock_server(args):
+    command = [
+        sys.executable, os.path.join(BENCHMARKS, "mock_server.py"),
+        "--port", "0",
+        "--fields", str(args.fields),
+        "--latency", str(args.latency),
+        "--jitter", str(args.jitter),
+        "--max-page-size", str(args.max_page_size),
+    ]
+    if args.rate:
+        command += ["--rate", str(args.rate)]
+    if args.retry_after is not None:
+        command += ["--retry-after", str(args.retry_after)]
+    if args.fixtures:
+        command += ["--fixtures", args.fixtures]
+
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    # the server prints its URL once it is listening
+    line = server.stdout.readline()
+    if not line.startswith("Serving on "):
+        server.kill()
+        raise RuntimeError("The mock server did not start")
+    return server, line.split()[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API client paths of the examples against the mock API server.")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append", help="run only this scenario (may be repeated)")
+    parser.add_argument("--fields", type=int, default=2000, help="number of fields served by the mock server")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--max-page-size", type=int, default=100)
+    parser.add_argument("--rate", type=float, help="requests per second allowed by the mock server before it throttles")
+    parser.add_argument("--retry-after", type=float)
+    parser.add_argument("--fixtures", help="replay recorded responses from this directory")
+    parser.add_argument("--charts", action="store_true", help="draw the charts of the processing scenarios")
+    parser.add_argument("--json", action="store_true", help="print the measurements as JSON lines")
+    # used to run a single scenario against an already running server
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_scenario(args.run, args.base_url, args.page_size, args.charts)))
+        return
+
+    server, base_url = start_mock_server(args)
+    try:
+        measurements = []
+        for name in args.scenario or SCENARIOS:
+            command = [sys.executable, os.path.abspath(__file__), "--run", name, "--base-url", base_url, "--page-size", str(args.page_size)]
+            if args.charts:
+                command.append("--charts")
+            # a scenario which fails (its traceback is shown) is recorded, and the rest still run
+            process = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+            if process.returncode:
+                measurements.append({"scenario": name, "error": f"exit code {process.returncode}"})
+            else:
+                measurements.append(json.loads(process.stdout.strip().splitlines()[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.json:
+        for measurement in measurements:
+            print(json.dumps(measurement))
+    else:
+        print(f"{'scenario':<24}{'results':>9}{'requests':>10}{'seconds':>9}{'req/s':>9}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'peak MB':>9}")
+        for m in measurements:
+            if "error" in m:
+                print(f"{m['scenario']:<24}  failed ({m['error']})")
+                continue
+            print(
+                f"{m['scenario']:<24}{m['results']:>9}{m['requests']:>10}{m['seconds']:>9.2f}{m['requests_per_second']:>9.1f}"
+                f"{m['p50'] * 1000:>9.1f}{m['p90'] * 1000:>9.1f}{m['p99'] * 1000:>9.1f}{m['peak_rss_mb']:>9.1f}"
+            )
+
+    if any("error" in measurement for measurement in measurements):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/bin/python3
+
+# Compares building the monthly date index row by row (the previous
+# implementation of convert_year_month_columns_to_date) with the vectorised
+# version now used by the Field Explorer examples.
+#
+#   $ python benchmarks/bench_dates.py --rows 1000000
+
+import argparse
+import os
+import sys
+import time
+from datetime import date
+
+import numpy
+import pandas
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "field-explorer-examples"))
+# field_search requires an API key on import; no requests are made here.
+os.environ.setdefault("API_KEY", "benchmark")
+
+from field_search import convert_year_month_columns_to_date  # noqa: E402
+
+
+def row_wise_convert_year_month_columns_to_date(dataframe):
+    dataframe.index = pandas.to_datetime(dataframe.apply(lambda x: datapoint_date_to_date(x), axis=1))
+    return dataframe
+
+
+def datapoint_date_to_date(datapoint):
+    try:
+        return date(year=int(datapoint['year']), month=int(datapoint['month']), day=1)
+    except KeyError:
+        return datapoint['dateTime']
+
+
+def monthly_datapoints(rows):
+    generator = numpy.random.default_rng(0)
+    return pandas.DataFrame({
+        'year': generator.integers(2000, 2021, rows),
+        'month': generator.integers(1, 13, rows),
+        'value': generator.random(rows) * 100,
+    })
+
+
+def timed(function, dataframe):
+    start = time.perf_counter()
+    result = function(dataframe.copy())
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark building the monthly date index of a rainfall series.")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    dataframe = monthly_datapoints(args.rows)
+
+    vectorised_seconds, vectorised = timed(convert_year_month_columns_to_date, dataframe)
+    row_wise_seconds, row_wise = timed(row_wise_convert_year_month_columns_to_date, dataframe)
+
+    assert (vectorised.index == row_wise.index).all()
+
+    print(f"rows:       {args.rows}")
+    print(f"row-wise:   {row_wise_seconds:.3f}s")
+    print(f"vectorised: {vectorised_seconds:.3f}s")
+    print(f"speedup:    {row_wise_seconds / vectorised_seconds:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+#!/bin/python3
+
+# A local stand-in for the Agrimetrics APIs used by the examples, for
+# running them (and benchmarking them) without an API key or network.
+#
+# It answers Field Boundaries, Field Search, Field Finder, Field Facts,
+# Field Trends, Field Forecasts and GraphQL requests with synthetic data,
+# paged as the real APIs page it, after a configurable latency. Requests
+# can be throttled (429) above a configured rate, and responses recorded
+# from the real API can be replayed in place of the synthetic data.
+#
+#   $ python benchmarks/mock_server.py --port 8080 --latency 0.05
+#   $ API_BASE_URL=http://localhost:8080 API_KEY=mock python field-explorer-examples/field_boundaries.py
+#
+# To record fixtures from the real API (using the API key sent by the
+# client), and then replay them:
+#
+#   $ python benchmarks/mock_server.py --record https://api.agrimetrics.co.uk --fixtures fixtures/
+#   $ python benchmarks/mock_server.py --fixtures fixtures/
+#
+# GET /_stats returns the number of requests served and throttled.
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+SOIL_LAYER_TYPES = "http://data.agrimetrics.co.uk/soil-layer-types/"
+SOIL_TEXTURE_TYPES = "http://data.agrimetrics.co.uk/soil-texture-types/"
+TEXTURES = ["clay", "clay-loam", "sandy-loam", "silty-clay", "loam"]
+
+
+class MockApi:
+    def __init__(self, fields=1000, latency=0.0, jitter=0.0, max_page_size=100, rate=None, retry_after=None,
+                 fixtures=None, record=None, today=None, seed=0):
+        self.fields = fields
+        self.latency = latency
+        self.jitter = jitter
+        self.max_page_size = max_page_size
+        self.rate = rate
+        self.retry_after = retry_after
+        self.fixtures = fixtures
+        self.record = record
+        self.today = today or date.today()
+        self.seed = seed
+
+        self.lock = threading.Lock()
+        self.tokens = rate or 0
+        self.last_refill = time.monotonic()
+        self.stats = {"requests": 0, "throttled": 0, "replayed": 0, "recorded": 0}
+
+    def handle(self, method, path, headers, body):
+        """
+        Return (status, headers, body) for a request.
+        """
+        parsed = urllib.parse.urlparse(path)
+        if parsed.path == "/_stats":
+            return 200, {"Content-Type": "application/json"}, json.dumps(self.stats).encode()
+
+        with self.lock:
+            self.stats["requests"] += 1
+        if self.throttled():
+            with self.lock:
+                self.stats["throttled"] += 1
+            response_headers = {"Content-Type": "application/json"}
+            if self.retry_after is not None:
+                response_headers["Retry-After"] = str(self.retry_after)
+            return 429, response_headers, b'{"statusCode": 429, "message": "Rate limit is exceeded."}'
+
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if self.record:
+            return self.record_response(method, path, headers, body)
+
+        if self.fixtures:
+            fixture = self.read_fixture(fixture_key(method, path, body))
+            if fixture:
+                with self.lock:
+                    self.stats["replayed"] += 1
+                return fixture
+
+        query = urllib.parse.parse_qs(parsed.query)
+        accept_geojson = "geo+json" in headers.get("accept", "")
+        route = parsed.path.rstrip("/")
+
+        if route == "/field-boundaries":
+            return json_response(self.field_boundaries(query, accept_geojson))
+        if route.startswith("/field-boundaries/"):
+            return json_response(self.field_boundary(route.rsplit("/", 1)[1], accept_geojson))
+        if route == "/field-search":
+            return json_response(self.field_search(query))
+        if route == "/field-finder":
+            return json_response(self.field_finder(query))
+        if route.startswith(("/field-facts/", "/field-trends/", "/field-forecasts/")):
+            api, field_id = route.strip("/").split("/", 1)
+            return json_response(getattr(self, api.replace("-", "_"))(field_id))
+        if route == "/graphql" and method == "POST":
+            return json_response(self.graphql(json.loads(body or b"{}")))
+
+        return 404, {"Content-Type": "application/json"}, b'{"statusCode": 404, "message": "Resource not found"}'
+
+    def throttled(self):
+        if not self.rate:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+    # Record and replay
+
+    def fixture_path(self, key):
+        return os.path.join(self.fixtures, f"{key}.json")
+
+    def read_fixture(self, key):
+        try:
+            with open(self.fixture_path(key)) as f:
+                fixture = json.load(f)
+        except FileNotFoundError:
+            return None
+        return fixture["status"], {"Content-Type": fixture["contentType"]}, fixture["body"].encode()
+
+    def record_response(self, method, path, headers, body):
+        forwarded = {name: value for name, value in headers.items() if name.lower() in ("accept", "content-type", "ocp-apim-subscription-key")}
+        response = requests.request(method, self.record.rstrip("/") + path, headers=forwarded, data=body)
+        content_type = response.headers.get("Content-Type", "application/json")
+
+        if self.fixtures and response.status_code < 500:
+            os.makedirs(self.fixtures, exist_ok=True)
+            with open(self.fixture_path(fixture_key(method, path, body)), "w") as f:
+                json.dump({"method": method, "path": path, "status": response.status_code,
+                           "contentType": content_type, "body": response.text}, f)
+            with self.lock:
+                self.stats["recorded"] += 1
+
+        return response.status_code, {"Content-Type": content_type}, response.content
+
+    # Synthetic data
+
+    def field_ids(self):
+        return [f"mock{i:06d}" for i in range(self.fields)]
+
+    def field_rng(self, field_id):
+        return random.Random(f"{self.seed}:{field_id}")
+
+    def boundary(self, field_id):
+        rng = self.field_rng(field_id)
+        lon = -0.5 + rng.random() * 0.3
+        lat = 51.7 + rng.random() * 0.2
+        size = 0.001 + rng.random() * 0.004
+        ring = [[lon, lat], [lon + size, lat], [lon + size, lat + size * 0.6], [lon, lat + size * 0.6], [lon, lat]]
+        return {"type": "Polygon", "coordinates": [ring]}
+
+    def page(self, items, page_size, page_num):
+        page_size = min(page_size, self.max_page_size)
+        start = (page_num - 1) * page_size
+        return items[start:start + page_size]
+
+    def field_boundaries(self, query, geojson):
+        page_size = int(query.get("pageSize", ["100"])[0])
+        page_num = int(query.get("pageNum", ["1"])[0])
+        ids = self.page(self.field_ids(), page_size, page_num)
+        if geojson:
+            return {"type": "FeatureCollection", "features": [self.boundary_feature(field_id) for field_id in ids]}
+        return {"results": [{"id": field_id, "boundary": self.boundary(field_id)} for field_id in ids]}
+
+    def field_boundary(self, field_id, geojson):
+        if geojson:
+            return {"type": "FeatureCollection", "features": [self.boundary_feature(field_id)]}
+        return {"results": [{"id": field_id, "boundary": self.boundary(field_id)}]}
+
+    def boundary_feature(self, field_id):
+        return {"type": "Feature", "properties": {"id": field_id}, "geometry": self.boundary(field_id)}
+
+    def field_search(self, query):
+        top = min(int(query.get("$top", ["100"])[0]), self.max_page_size)
+        skip = int(query.get("$skip", ["0"])[0])
+        ids = self.field_ids()[skip:skip + top]
+        return {"totalResults": self.fields, "results": [self.search_result(field_id) for field_id in ids]}
+
+    def search_result(self, field_id):
+        return {
+            "@id": f"https://data.agrimetrics.co.uk/fields/{field_id}",
+            "hasMonthlyTotalRainfall": {"hasDatapoint": self.monthly_rainfall(field_id)},
+            "hasLongTermAverageMonthlyTotalRainfall": {"hasDatapoint": self.monthly_rainfall(field_id, months=12)},
+            "hasSoilLayer": self.soil_layers(field_id),
+        }
+
+    def monthly_rainfall(self, field_id, months=36):
+        rng = self.field_rng(field_id)
+        first = self.today.year * 12 + self.today.month - 1 - months
+        return [
+            {"year": month // 12, "month": month % 12 + 1, "value": round(rng.uniform(10, 120), 1)}
+            for month in range(first, first + months)
+        ]
+
+    def soil_layers(self, field_id):
+        rng = self.field_rng(field_id)
+        layers = []
+        for layer_type in ("topsoil", "subsoil"):
+            sand = rng.randint(10, 70)
+            clay = rng.randint(5, 100 - sand - 5)
+            layers.append({
+                "hasSoilLayerType": SOIL_LAYER_TYPES + layer_type,
+                "hasSoilTexture": {
+                    "sandPercentage": sand,
+                    "clayPercentage": clay,
+                    "siltPercentage": 100 - sand - clay,
+                    "hasSoilTextureType": SOIL_TEXTURE_TYPES + rng.choice(TEXTURES),
+                },
+                "hasChemicalProperty": {"pH": round(rng.uniform(5.5, 8), 1)},
+            })
+        return layers
+
+    def field_finder(self, query):
+        lat = float(query["lat"][0])
+        lon = float(query["lon"][0])
+        field_id = self.field_ids()[int(abs(lat * 1000) + abs(lon * 1000)) % self.fields]
+        return {
+            "@id": f"https://data.agrimetrics.co.uk/fields/{field_id}",
+            "_links": {
+                f"ag:api:{api}": {"href": f"https://api.agrimetrics.co.uk/{api}/{field_id}"}
+                for api in ("field-facts", "field-trends", "field-forecasts")
+            },
+        }
+
+    def field_facts(self, field_id):
+        return {"hasSoilLayer": self.soil_layers(field_id)}
+
+    def field_trends(self, field_id):
+        return {"hasMonthlyTotalRainfall": {"hasDatapoint": self.monthly_rainfall(field_id)}}
+
+    def field_forecasts(self, field_id):
+        rng = self.field_rng(field_id)
+        return {
+            "hasForecastDailyMaximumTemperature": {
+                "hasDatapoint": [
+                    {"dateTime": f"{self.today + timedelta(days=day)}T00:00:00Z", "value": round(rng.uniform(5, 25), 1)}
+                    for day in range(7)
+                ]
+            }
+        }
+
+    # GraphQL: enough of the queries made by the examples to page through
+    # fields and weather observations, including aliased (batched) queries.
+
+    def graphql(self, request):
+        query = request.get("query", "")
+        variables = request.get("variables") or {}
+
+        aliases = re.findall(r"(\w+)\s*:\s*node\s*\(\s*id:\s*\$(\w+)", query)
+        if aliases:
+            data = {}
+            for alias, id_variable in aliases:
+                suffix = id_variable[len("id"):]
+                data[alias] = self.weather_node(query, variables, suffix)
+            return {"data": data}
+
+        if re.search(r"\bnode\s*\(", query):
+            return {"data": {"node": self.weather_node(query, variables, "")}}
+
+        if re.search(r"\bfields\s*\(", query):
+            return {"data": {"fields": self.graphql_fields(query, variables)}}
+
+        return {"errors": [{"message": "The mock server does not support this query"}]}
+
+    def graphql_fields(self, query, variables):
+        first = variables.get("first") or int((re.search(r"\bfirst:\s*(\d+)", query) or [None, 100])[1])
+        start = int(variables.get("cursor") or 0)
+        ids = self.field_ids()[start:start + min(first, self.max_page_size)]
+
+        fields = []
+        for i, field_id in enumerate(ids):
+            ring = self.boundary(field_id)["coordinates"][0]
+            centroid = [(ring[0][0] + ring[2][0]) / 2, (ring[0][1] + ring[2][1]) / 2]
+            fields.append({
+                "id": f"agfd:{field_id}",
+                "cursor": str(start + i + 1),
+                "location": {"centroid": {"type": "Point", "coordinates": centroid}},
+                "soil": {"topSoil": {"texture": {"type": self.field_rng(field_id).choice(TEXTURES)}}},
+            })
+        return fields
+
+    def weather_node(self, query, variables, suffix):
+        field_id = variables.get(f"id{suffix}")
+        start_date = date.fromisoformat(variables.get(f"startDate{suffix}") or str(self.today - timedelta(days=30)))
+        start = int(variables.get(f"cursor{suffix}") or 0)
+        days = max(0, (self.today - start_date).days + 1)
+
+        page_size = min(variables.get(f"first{suffix}") or self.max_page_size, self.max_page_size)
+        end = min(days, start + page_size)
+        rng = self.field_rng(field_id)
+
+        observations = {"cursor": str(end) if end < days else None}
+        for variable in set(re.findall(r"(\w+)\s*(?:\([^)]*\))?\s*\{\s*value\s+dateTime\s*\}", query)):
+            observations[variable] = [
+                {"value": round(rng.uniform(0, 15), 2), "dateTime": f"{start_date + timedelta(days=day)}T00:00:00Z"}
+                for day in range(start, end)
+            ]
+        return {"weatherObservations": observations}
+
+
+def fixture_key(method, path, body):
+    parsed = urllib.parse.urlparse(path)
+    # the API key is sent in a header, so fixtures recorded with one key replay for any
+    query = sorted(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+    digest = hashlib.sha256()
+    digest.update(json.dumps([method, parsed.path, query]).encode())
+    digest.update(body or b"")
+    return digest.hexdigest()[:32]
+
+
+def json_response(data):
+    return 200, {"Content-Type": "application/json"}, json.dumps(data).encode()
+
+
+def handler_for(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # buffer each response and send it in one write
+        wbufsize = -1
+
+        def do_GET(self):
+            self.respond()
+
+        def do_POST(self):
+            self.respond()
+
+        def respond(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else None
+            headers = {name.lower(): value for name, value in self.headers.items()}
+
+            status, response_headers, response_body = api.handle(self.command, self.path, headers, body)
+
+            self.send_response(status)
+            for name, value in response_headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(response_body)))
+            self.end_headers()
+            self.wfile.write(response_body)
+            self.wfile.flush()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(api, host="127.0.0.1", port=0):
+    """
+    Start serving `api` on a background thread, returning the server; its
+    URL is server.url.
+    """
+    server = ThreadingHTTPServer((host, port), handler_for(api))
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the Agrimetrics APIs.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--fields", type=int, default=1000, help="number of fields matched by every query")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random variation in the latency, in seconds")
+    parser.add_argument("--max-page-size", type=int, default=100, help="largest page returned, whatever is asked for")
+    parser.add_argument("--rate", type=float, help="requests per second allowed before throttling with 429")
+    parser.add_argument("--retry-after", type=float, help="Retry-After seconds sent with 429 responses")
+    parser.add_argument("--fixtures", help="directory of recorded responses to replay (or to record to)")
+    parser.add_argument("--record", metavar="URL", help="forward requests to this API and record the responses")
+    args = parser.parse_args()
+
+    api = MockApi(
+        fields=args.fields,
+        latency=args.latency,
+        jitter=args.jitter,
+        max_page_size=args.max_page_size,
+        rate=args.rate,
+        retry_after=args.retry_after,
+        fixtures=args.fixtures,
+        record=args.record,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), handler_for(api))
+    print(f"Serving on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,892 @@
+import codecs
+import email.utils
+import hashlib
+import json as jsonlib
+import os
+import random
+import re
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+import tracing
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# Shared HTTP client for the examples. All requests go through one
+# requests.Session, so connections (and their TLS sessions) are kept alive
+# and reused rather than being set up again for every call.
+#
+# Each call is timed as a span (see tracing.py) recording the time spent in
+# each phase of the request, the bytes transferred and whether the response
+# came from the cache.
+#
+# This module is shared by the examples of several directories, which add
+# this directory to sys.path before importing it.
+
+# Maximum number of keep-alive connections held open per host. This should
+# be at least the number of requests made concurrently.
+POOL_SIZE = int(os.environ.get("API_POOL_SIZE", 10))
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (10, 120)
+
+# Requests for the Agrimetrics API are sent to API_BASE_URL instead when it
+# is set, e.g. to run the examples against benchmarks/mock_server.py.
+API_URL = "https://api.agrimetrics.co.uk"
+API_BASE_URL = os.environ.get("API_BASE_URL")
+
+# Responses are decompressed by urllib3; it can only decode brotli when
+# one of the brotli packages is installed.
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    try:
+        import brotlicffi  # noqa: F401
+        ACCEPT_ENCODING = "gzip, deflate, br"
+    except ImportError:
+        ACCEPT_ENCODING = "gzip, deflate"
+
+
+# How long (in seconds) cached responses are kept for, by URL path prefix.
+# Data which rarely changes, such as boundaries and soil, is kept longest.
+HOUR = 60 * 60
+DAY = 24 * HOUR
+CACHE_TTLS = {
+    "/field-boundaries": 30 * DAY,
+    "/field-facts": 30 * DAY,
+    "/field-finder": 30 * DAY,
+    "/field-search": DAY,
+    "/field-trends": DAY,
+    "/field-forecasts": HOUR,
+    "/graphql": DAY,
+}
+DEFAULT_CACHE_TTL = DAY
+
+# Upper limit on the total size of cached response bodies, in bytes. The
+# least recently used responses are evicted to stay under it.
+CACHE_MAX_BYTES = int(os.environ.get("API_CACHE_MAX_BYTES", 1024 ** 3))
+
+# Throttled (429) and failed (5xx) requests are retried up to MAX_RETRIES
+# times. The wait before each retry is the server's Retry-After when given,
+# otherwise a random time up to BACKOFF_BASE * 2 ** attempt seconds
+# ("full jitter"), capped at BACKOFF_MAX.
+MAX_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+# Failures to connect, or to receive a whole response, which are retried
+# like failed statuses
+RETRY_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure(pool_size=None, timeout=None, cache=None, base_url=None):
+    """
+    Change the connection pool size, default timeout, response cache and/or
+    API base URL. Pass cache=False to turn caching off. The shared session is
+    replaced, so this is best called before making any requests.
+    """
+    global POOL_SIZE, TIMEOUT, CACHE, LIMITER, API_BASE_URL, _session
+
+    with _session_lock:
+        if base_url is not None:
+            API_BASE_URL = base_url
+        if pool_size is not None:
+            POOL_SIZE = pool_size
+            LIMITER = AdaptiveLimiter(pool_size)
+        if timeout is not None:
+            TIMEOUT = timeout
+        if cache is not None:
+            CACHE = cache or None
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def session():
+    """
+    Return the shared session, creating it on first use.
+    """
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = create_session(POOL_SIZE)
+        return _session
+
+
+def create_session(pool_size):
+    adapter = TimedHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+    new_session = requests.Session()
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    new_session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    return new_session
+
+
+# Request phase timings. New connections are made by the classes below,
+# which record how long the host name took to resolve, the TCP connection
+# to open and the TLS handshake, for the request being made on the thread.
+# They resolve the host name themselves (only while tracing, as urllib3
+# would otherwise do it out of sight) and connect to each address in turn.
+#
+# urllib3 has no public hook for these timings, so the classes override
+# some of its internals. Where those are missing (another urllib3 version),
+# or API_CONNECTION_TIMINGS is set to 0, plain connections are used instead
+# and the time spent connecting is counted in the time to first byte.
+CONNECTION_TIMINGS = os.environ.get("API_CONNECTION_TIMINGS", "1") != "0"
+
+_connection_timings = threading.local()
+
+
+def connection_timings():
+    try:
+        return _connection_timings.timings
+    except AttributeError:
+        _connection_timings.timings = {}
+        return _connection_timings.timings
+
+
+def record_request_timings(response, current):
+    timings = connection_timings()
+    for phase, seconds in timings.items():
+        current.add_timing(phase, seconds)
+    # response.elapsed runs from sending the request (including making a
+    # new connection) until the headers were read, as the body is streamed
+    current.add_timing("ttfb", max(0.0, response.elapsed.total_seconds() - sum(timings.values())))
+
+
+class TimedConnectionMixin:
+    def connect(self):
+        if not tracing.enabled():
+            return super().connect()
+        start = time.perf_counter()
+        super().connect()
+        timings = connection_timings()
+        elapsed = time.perf_counter() - start
+        if "connect" not in timings:
+            # _new_conn could not time the phases, so they are counted as one
+            timings["connect"] = elapsed
+        elif isinstance(self, HTTPSConnection):
+            timings["tls"] = elapsed - timings.get("dns", 0) - timings.get("connect", 0)
+
+    def _new_conn(self):
+        host = getattr(self, "_dns_host", None)
+        if not tracing.enabled() or not host:
+            return super()._new_conn()
+
+        timings = connection_timings()
+        start = time.perf_counter()
+        try:
+            addresses = [address[4][0] for address in socket.getaddrinfo(host, self.port, type=socket.SOCK_STREAM)]
+        except OSError:
+            # leave urllib3 to report the failure
+            addresses = [host]
+        timings["dns"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        try:
+            for i, address in enumerate(addresses):
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError):
+                    if i == len(addresses) - 1:
+                        raise
+        finally:
+            self._dns_host = host
+            timings["connect"] = time.perf_counter() - start
+
+
+class TimedHTTPConnection(TimedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(TimedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+def timed_connections_supported():
+    return (
+        hasattr(HTTPConnection, "_new_conn")
+        and hasattr(HTTPConnectionPool, "ConnectionCls")
+        and hasattr(HTTPSConnectionPool, "ConnectionCls")
+    )
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        if CONNECTION_TIMINGS and timed_connections_supported() and hasattr(self.poolmanager, "pool_classes_by_scheme"):
+            self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+
+def get_json(url, headers=None, timeout=None, ttl=None):
+    """
+    GET a URL and return the decoded JSON body, raising for error statuses.
+    When a response cache is configured, a fresh cached response for the
+    same URL is returned instead of making the request.
+    """
+    with tracing.span("api_client.get_json", url=url) as current:
+        key = cache_key("GET", url, headers) if CACHE else None
+        body = cached_body(key, current)
+        if body is None:
+            body = request("GET", url=url, headers=headers, timeout=timeout or TIMEOUT, stream=True, read=True).content
+            # only bodies which decode are cached, so an error page is not kept
+            result = decode_body(body, current)
+            if key:
+                CACHE.set(key, body, cache_ttl(url) if ttl is None else ttl)
+        else:
+            result = decode_body(body, current)
+
+        return result
+
+
+def post_json(url, json, headers=None, timeout=None, ttl=None, with_size=False, uncached_variables=(),
+              no_retry_statuses=(), retry_timeouts=True):
+    """
+    POST a JSON body to a URL and return the decoded JSON response, raising
+    for error statuses. GraphQL queries (but not mutations) are cached on
+    the query text and variables when a response cache is configured, save
+    for the variables named in uncached_variables (e.g. the size of a page
+    of a cursor chain, which any cached page will do for). Responses
+    reporting GraphQL errors are never cached. With with_size, returns
+    (response, size of the response body in bytes). Statuses in
+    no_retry_statuses, and timeouts unless retry_timeouts, are raised at
+    once rather than retried (see request).
+    """
+    with tracing.span("api_client.post_json", url=url, operation=(json or {}).get("operationName")) as current:
+        key = cache_key("POST", url, headers, json, uncached_variables) if CACHE and not is_mutation(json) else None
+        body = cached_body(key, current)
+        if body is None:
+            response = request(
+                "POST",
+                url=url,
+                headers=headers,
+                json=json,
+                timeout=timeout or TIMEOUT,
+                stream=True,
+                idempotent=not is_mutation(json),
+                read=True,
+                no_retry_statuses=no_retry_statuses,
+                retry_timeouts=retry_timeouts,
+            )
+            body = response.content
+            result = decode_body(body, current)
+            if key and not result.get("errors"):
+                CACHE.set(key, body, cache_ttl(url) if ttl is None else ttl)
+        else:
+            result = decode_body(body, current)
+
+        return (result, len(body)) if with_size else result
+
+
+def cached_body(key, current):
+    body = CACHE.get(key) if key else None
+    if key:
+        current.set(cache="miss" if body is None else "hit")
+    if body is not None:
+        current.set(bytes=len(body))
+    return body
+
+
+def read_body(response, current):
+    start = time.perf_counter()
+    body = response.content
+    current.add_timing("download", time.perf_counter() - start)
+    current.set(bytes=len(body), wireBytes=response.raw.tell() if hasattr(response.raw, "tell") else None)
+    return body
+
+
+def decode_body(body, current):
+    start = time.perf_counter()
+    result = jsonlib.loads(body)
+    current.add_timing("decode", time.perf_counter() - start)
+    return result
+
+
+def stream_json_array(method, url, path, headers=None, json=None, timeout=None):
+    """
+    Make a request and return a JsonArrayStream over the JSON array found
+    by following the object keys in `path` from the top of the response
+    body, e.g. ("results",) or ("data", "fields"). The elements are decoded
+    one at a time as the body arrives, so the whole body is never held in
+    memory. Streamed responses are served from the cache when present, but
+    are not added to it.
+    """
+    # the span ends when the stream is closed, rather than when it is returned
+    current = tracing.Span("api_client.stream_json_array", {"url": url})
+    try:
+        key = None
+        if CACHE and (method == "GET" or not is_mutation(json)):
+            key = cache_key(method, url, headers, json)
+        body = cached_body(key, current)
+        if body is not None:
+            return JsonArrayStream([body], path, span=current)
+
+        with tracing.use_span(current):
+            response = request(
+                method,
+                url=url,
+                headers=headers,
+                json=json,
+                timeout=timeout or TIMEOUT,
+                stream=True,
+                idempotent=method == "GET" or not is_mutation(json),
+            )
+    except BaseException as e:
+        tracing.end(current, error=e)
+        raise
+    return JsonArrayStream(response.iter_content(chunk_size=STREAM_CHUNK_SIZE), path, response, span=current)
+
+
+def request(method, url, idempotent=True, read=False, no_retry_statuses=(), retry_timeouts=True, **kwargs):
+    """
+    Make a request through the shared session and concurrency limiter,
+    retrying throttled and failed attempts with backoff. Requests which are
+    not idempotent (GraphQL mutations) are only retried when throttled, as
+    the server will not have acted on them. With read, the body is read
+    before returning, so that a response cut short is retried too. Raises
+    for error statuses once the retries are used up, or at once for those in
+    no_retry_statuses (and for timeouts, unless retry_timeouts), e.g. when
+    the caller will ask again for less.
+    """
+    url = rebase_url(url)
+    current = tracing.current_span() or tracing.Span("api_client.request", {})
+    for attempt in range(MAX_RETRIES + 1):
+        current.set(attempts=attempt + 1)
+        try:
+            response = limited_request(method, url, current, **kwargs)
+            current.set(status=response.status_code)
+
+            retry = (
+                response.status_code in RETRY_STATUSES
+                and response.status_code not in no_retry_statuses
+                and (idempotent or response.status_code == 429)
+            )
+            if not retry or attempt == MAX_RETRIES:
+                response.raise_for_status()
+                if read:
+                    read_body(response, current)
+                return response
+        except RETRY_ERRORS as e:
+            if not idempotent or attempt == MAX_RETRIES or (not retry_timeouts and isinstance(e, requests.Timeout)):
+                raise
+            sleep(backoff(attempt), current)
+            continue
+
+        response.close()
+        sleep(retry_after(response) or backoff(attempt), current)
+
+
+def limited_request(method, url, current, **kwargs):
+    """
+    Make one attempt at a request, holding a slot of the concurrency limiter
+    until the response headers arrive (or the attempt fails).
+    """
+    start = time.perf_counter()
+    token = LIMITER.acquire()
+    current.add_timing("queue", time.perf_counter() - start)
+    connection_timings().clear()
+    throttled = False
+    try:
+        response = session().request(method, url, **kwargs)
+        throttled = response.status_code in THROTTLE_STATUSES
+        record_request_timings(response, current)
+        return response
+    finally:
+        LIMITER.release(token, throttled=throttled)
+
+
+def sleep(seconds, current):
+    current.add_timing("backoff", seconds)
+    time.sleep(seconds)
+
+
+def rebase_url(url):
+    if API_BASE_URL and url.startswith(API_URL):
+        return API_BASE_URL.rstrip("/") + url[len(API_URL):]
+    return url
+
+
+def backoff(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after(response):
+    """
+    Seconds to wait according to the Retry-After header (given either as a
+    number of seconds or as an HTTP date), or None if it is absent.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(BACKOFF_MAX, max(0, seconds))
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of requests in flight at once, adapting the limit to
+    the server: it halves when a request is throttled and creeps back up by
+    about one for each limit's worth of successful requests (additive
+    increase, multiplicative decrease). Only one decrease is made for any
+    window of requests, so a burst of throttled responses to requests
+    which were already in flight is counted once.
+    """
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self._generation = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self._generation
+
+    def release(self, token, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                if token == self._generation:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._generation += 1
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+LIMITER = AdaptiveLimiter(POOL_SIZE)
+
+
+# Streaming JSON decoding
+
+# Number of (decompressed) bytes read from the socket at a time.
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Characters which may continue a number, up to the end of the buffer
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*\Z")
+
+
+class JsonArrayStream:
+    """
+    Iterates over the elements of one JSON array inside a document which
+    arrives in chunks of bytes. The other top-level members (e.g.
+    totalResults) are kept in `members`: those before the array as soon as
+    the stream is made, and the rest once the array has been read. GraphQL
+    errors, wherever they appear, make the stream raise once the document
+    has been read, or at once if the array is missing.
+    """
+
+    def __init__(self, chunks, path, response=None, span=None):
+        self.members = {}
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._response = response
+        self._span = span
+        self._bytes = 0
+        self._buffer = ""
+        self._position = 0
+        self._ended = False
+        # the number of objects entered on the way to the array
+        self._depth = 0
+        self._decoder = jsonlib.JSONDecoder()
+        try:
+            self._found = self._find(path)
+        except BaseException:
+            self.close()
+            raise
+
+    def __iter__(self):
+        try:
+            if not self._found:
+                return
+            if self._peek() != "]":
+                while True:
+                    yield self._value()
+                    separator = self._peek()
+                    if separator == "]":
+                        break
+                    if separator != ",":
+                        raise ValueError(f"Expected ',' or ']' in JSON array, found {separator!r}")
+                    self._position += 1
+            self._position += 1
+            self._finish()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+        if self._span is not None:
+            self._span.set(bytes=self._bytes)
+            if self._response is not None and hasattr(self._response.raw, "tell"):
+                self._span.set(wireBytes=self._response.raw.tell())
+            tracing.end(self._span)
+            self._span = None
+
+    def _find(self, path):
+        """
+        Move to just inside the array at `path`. Returns False if the value
+        there is null.
+        """
+        for depth, key in enumerate(path):
+            if self._peek() == "n":
+                self._value()
+                self._finish()
+                return False
+            self._expect("{")
+            self._depth += 1
+            while True:
+                if self._peek() == "}":
+                    self._finish()
+                    raise ValueError(f"No {'.'.join(path)} in response")
+                member = self._value()
+                self._expect(":")
+                if member == key:
+                    break
+                value = self._value()
+                if depth == 0:
+                    self.members[member] = value
+                if self._peek() == ",":
+                    self._position += 1
+
+        if self._peek() == "n":
+            self._value()
+            self._finish()
+            return False
+        self._expect("[")
+        return True
+
+    def _finish(self):
+        """
+        Read the rest of the document after the value at (or on the way to)
+        `path`, keeping the remaining top-level members, then raise any
+        GraphQL errors. GraphQL servers may send errors after the data.
+        """
+        while self._depth:
+            while self._peek() == ",":
+                self._position += 1
+                member = self._value()
+                self._expect(":")
+                value = self._value()
+                if self._depth == 1:
+                    self.members[member] = value
+            self._expect("}")
+            self._depth -= 1
+
+        errors = self.members.get("errors")
+        if errors:
+            raise ValueError(f"GraphQL query errors: {errors}")
+
+    def _fill(self):
+        if self._ended:
+            return False
+        if self._position > len(self._buffer) // 2:
+            self._buffer = self._buffer[self._position:]
+            self._position = 0
+        start = time.perf_counter()
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._buffer += self._text.decode(b"", final=True)
+            self._ended = True
+            return False
+        finally:
+            if self._span is not None:
+                self._span.add_timing("download", time.perf_counter() - start)
+        self._bytes += len(chunk)
+        self._buffer += self._text.decode(chunk)
+        return True
+
+    def _peek(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in " \t\r\n":
+                self._position += 1
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def _expect(self, character):
+        found = self._peek()
+        if found != character:
+            raise ValueError(f"Expected {character!r} in JSON response, found {found!r}")
+        self._position += 1
+
+    def _value(self):
+        # Decode the next complete value. A value which runs to the very end
+        # of the buffer may be cut short, so more is read first. So may a
+        # number followed only by what could continue it: "12." decodes as
+        # 12. After a failed attempt, the buffer is at least doubled before
+        # trying again, so a large value is not re-parsed per chunk.
+        self._peek()
+        threshold = 0
+        while True:
+            available = len(self._buffer) - self._position
+            if available >= threshold or self._ended:
+                try:
+                    value, end = self._decoder.raw_decode(self._buffer, self._position)
+                except jsonlib.JSONDecodeError:
+                    if self._ended:
+                        raise
+                else:
+                    cut_short = end == len(self._buffer) or (
+                        isinstance(value, (int, float)) and not isinstance(value, bool)
+                        and NUMBER_TAIL.match(self._buffer, end)
+                    )
+                    if not cut_short or self._ended:
+                        self._position = end
+                        return value
+                threshold = 2 * available
+            self._fill()
+
+
+# Response caching
+
+def cache_key(method, url, headers=None, body=None, uncached_variables=()):
+    """
+    Build a cache key from the normalised URL (query parameters sorted), the
+    Accept header and, for GraphQL, the query text with whitespace collapsed
+    plus its variables, other than those named in uncached_variables. The
+    subscription key is deliberately left out.
+    """
+    # keyed on the server actually asked, so mock responses never answer real requests
+    parts = urllib.parse.urlsplit(rebase_url(url))
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    normalised_url = urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ""))
+
+    accept = next((value for name, value in (headers or {}).items() if name.lower() == "accept"), "")
+
+    key = [method, normalised_url, accept]
+    if body is not None:
+        key.append(" ".join(body.get("query", "").split()))
+        variables = body.get("variables")
+        if variables and uncached_variables:
+            variables = {name: value for name, value in variables.items() if name not in uncached_variables}
+        key.append(jsonlib.dumps(variables, sort_keys=True))
+        key.append(body.get("operationName") or "")
+
+    return hashlib.sha256("\n".join(key).encode("utf-8")).hexdigest()
+
+
+def cache_ttl(url):
+    path = urllib.parse.urlsplit(url).path
+    for prefix, ttl in CACHE_TTLS.items():
+        if path.startswith(prefix):
+            return ttl
+    return DEFAULT_CACHE_TTL
+
+
+def is_mutation(body):
+    return isinstance(body, dict) and body.get("query", "").lstrip().startswith("mutation")
+
+
+class SqliteCache:
+    """
+    Response cache held in a single SQLite database file.
+    """
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # the total size of the stored bodies, kept as they are added and removed
+        self._total = None
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, body BLOB, size INTEGER, expires REAL, accessed REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT body, expires, size FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            body, expires, size = row
+            if expires <= now:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                if self._total is not None:
+                    self._total -= size
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            return bytes(body)
+
+    def set(self, key, body, ttl):
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            if self._total is None:
+                self._total = self._stored_size()
+            replaced = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, body, len(body), now + ttl, now),
+            )
+            self._total += len(body) - (replaced[0] if replaced else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _stored_size(self):
+        return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def _evict(self):
+        # other processes may share the file, so the total is counted again
+        # (rarely, as this only runs once the cache is full)
+        self._db.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+        total = self._stored_size()
+        evicted = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._total = total
+
+
+class FileCache:
+    """
+    Response cache holding one file per response in a directory. Each file
+    starts with its expiry time; its modification time records when it was
+    last used.
+    """
+
+    HEADER = struct.Struct("<d")
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                (expires,) = self.HEADER.unpack(f.read(self.HEADER.size))
+                if expires <= time.time():
+                    body = None
+                else:
+                    body = f.read()
+        except (FileNotFoundError, struct.error):
+            return None
+
+        if body is None:
+            self._remove(path)
+        else:
+            os.utime(path)
+        return body
+
+    def set(self, key, body, ttl):
+        if ttl <= 0 or len(body) > self.max_bytes:
+            return
+        path = self._path(key)
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(self.HEADER.pack(time.time() + ttl))
+            f.write(body)
+
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, _, size in self._entries())
+            self._total -= self._size(path)
+            os.replace(temporary_path, path)
+            self._total += self._size(path)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        for path, _, size in sorted(self._entries(), key=lambda entry: entry[1]):
+            if self._total <= self.max_bytes:
+                break
+            self._remove(path)
+            self._total -= size
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def cache_from_environment():
+    """
+    Set up the response cache named by the API_CACHE environment variable:
+    a path ending in .sqlite or .db selects a SQLite cache, any other path
+    a directory of cached files. Caching is off when it is not set.
+    """
+    location = os.environ.get("API_CACHE")
+    if not location:
+        return None
+    if location.endswith((".sqlite", ".db")):
+        return SqliteCache(location)
+    return FileCache(location)
+
+
+CACHE = cache_from_environment()
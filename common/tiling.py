@@ -0,0 +1,216 @@
+import math
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# Splitting large areas into tiles. A query over a large polygon or circle
+# returns many pages which can only be fetched one after another, following
+# a cursor or page number. Splitting the area into tiles and querying the
+# tiles in parallel turns that one long chain of requests into many short
+# ones. Fields which straddle the edges of tiles are returned for more than
+# one tile, so the results are merged by field id.
+#
+# Coordinates are (lon, lat) pairs in degrees, and polygons are given by
+# their outer ring, as in GeoJSON. Distances are in metres, and are measured
+# on a sphere, which is accurate enough over the few kilometres of a tile.
+#
+# This module is shared by the examples of several directories, which add
+# this directory to sys.path before importing it.
+
+EARTH_RADIUS = 6371008.8  # mean radius, in metres
+
+# Default edge length of a tile, in metres, and number of tiles queried at once.
+TILE_SIZE = 2500
+TILE_WORKERS = 8
+
+# A circular tile covering one square cell of the grid. `box` is the cell,
+# as (min_lon, min_lat, max_lon, max_lat).
+CircleTile = namedtuple("CircleTile", ["lon", "lat", "radius", "box"])
+
+
+def haversine_distance(lon1, lat1, lon2, lat2):
+    """
+    Great circle distance in metres between two points.
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def metres_to_degrees(metres, lat):
+    """
+    Return the (lon, lat) extent in degrees of `metres` east and north of a point at latitude `lat`.
+    """
+    d_lat = math.degrees(metres / EARTH_RADIUS)
+    d_lon = d_lat / max(math.cos(math.radians(lat)), 1e-6)
+    return d_lon, d_lat
+
+
+def bounding_box(ring):
+    lons = [lon for lon, _ in ring]
+    lats = [lat for _, lat in ring]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+def box_ring(box):
+    min_lon, min_lat, max_lon, max_lat = box
+    return [(min_lon, min_lat), (max_lon, min_lat), (max_lon, max_lat), (min_lon, max_lat), (min_lon, min_lat)]
+
+
+def grid(box, tile_size=TILE_SIZE):
+    """
+    Split a bounding box into a grid of square cells roughly `tile_size` metres across.
+    """
+    min_lon, min_lat, max_lon, max_lat = box
+    d_lon, d_lat = metres_to_degrees(tile_size, (min_lat + max_lat) / 2)
+    columns = max(1, math.ceil((max_lon - min_lon) / d_lon))
+    rows = max(1, math.ceil((max_lat - min_lat) / d_lat))
+    width = (max_lon - min_lon) / columns
+    height = (max_lat - min_lat) / rows
+
+    return [
+        (min_lon + column * width, min_lat + row * height, min_lon + (column + 1) * width, min_lat + (row + 1) * height)
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+def clip_polygon(ring, box):
+    """
+    Clip a polygon to a box (Sutherland-Hodgman), returning the closed ring of
+    the part inside the box, or None if they do not overlap. The part of a
+    concave polygon inside a box may be in several pieces, which are returned
+    as one ring joined by zero-width slivers along the edge of the box. Such
+    a ring has the right area, but is not a valid polygon to query with.
+    """
+    min_lon, min_lat, max_lon, max_lat = box
+    edges = [
+        (lambda p: p[0] >= min_lon, lambda p, q: intersect_vertical(p, q, min_lon)),
+        (lambda p: p[0] <= max_lon, lambda p, q: intersect_vertical(p, q, max_lon)),
+        (lambda p: p[1] >= min_lat, lambda p, q: intersect_horizontal(p, q, min_lat)),
+        (lambda p: p[1] <= max_lat, lambda p, q: intersect_horizontal(p, q, max_lat)),
+    ]
+
+    points = [tuple(point) for point in ring]
+    if points and points[0] == points[-1]:
+        points = points[:-1]
+
+    for inside, intersection in edges:
+        clipped = []
+        for i, current in enumerate(points):
+            previous = points[i - 1]
+            if inside(current):
+                if not inside(previous):
+                    clipped.append(intersection(previous, current))
+                clipped.append(current)
+            elif inside(previous):
+                clipped.append(intersection(previous, current))
+        points = clipped
+
+    if len(points) < 3 or polygon_area(points) == 0:
+        return None
+    return points + [points[0]]
+
+
+def intersect_vertical(p, q, lon):
+    t = (lon - p[0]) / (q[0] - p[0])
+    return lon, p[1] + t * (q[1] - p[1])
+
+
+def intersect_horizontal(p, q, lat):
+    t = (lat - p[1]) / (q[1] - p[1])
+    return p[0] + t * (q[0] - p[0]), lat
+
+
+def polygon_area(points):
+    return abs(sum(p[0] * q[1] - q[0] * p[1] for p, q in zip(points, points[1:] + points[:1]))) / 2
+
+
+def polygon_tiles(ring, tile_size=TILE_SIZE):
+    """
+    Split the bounding box of a polygon into a grid, returning the ring of
+    each cell which overlaps the polygon.
+
+    Together the cells cover the polygon, so every field which intersects the
+    polygon intersects at least one of them. They also cover fields outside
+    the polygon, and a field lying within the polygon may cross the edge of a
+    cell, so the fields found by querying the cells with "intersects" are
+    to be tested against the polygon itself.
+    """
+    return [box_ring(cell) for cell in grid(bounding_box(ring), tile_size) if clip_polygon(ring, cell)]
+
+
+def circle_tiles(lon, lat, radius, tile_size=TILE_SIZE):
+    """
+    Split a circle into a grid of square cells, returning a CircleTile for
+    each cell which overlaps the circle. Each tile's circle passes through the
+    corners of its cell, so every point of the original circle lies within
+    at least one tile's circle, and within exactly one cell (save for points
+    on the edges between cells).
+    """
+    cells = math.ceil(2 * radius / tile_size)
+    size = 2 * radius / cells
+    d_lon, d_lat = metres_to_degrees(size, lat)
+    half = cells / 2
+
+    tiles = []
+    for row in range(cells):
+        for column in range(cells):
+            # distance from the centre of the circle to the nearest point of the cell, in cells
+            x = max(column - half, half - column - 1, 0)
+            y = max(row - half, half - row - 1, 0)
+            if math.hypot(x, y) * size > radius:
+                continue
+
+            box = (
+                lon + (column - half) * d_lon,
+                lat + (row - half) * d_lat,
+                lon + (column + 1 - half) * d_lon,
+                lat + (row + 1 - half) * d_lat,
+            )
+            tiles.append(CircleTile(
+                lon=(box[0] + box[2]) / 2,
+                lat=(box[1] + box[3]) / 2,
+                # with 1% to spare, as the cells are not quite square away from the centre
+                radius=1.01 * size / math.sqrt(2),
+                box=box,
+            ))
+    return tiles
+
+
+def wkt_polygon(ring):
+    return "POLYGON(({}))".format(",".join(f"{lon} {lat}" for lon, lat in ring))
+
+
+def geojson_polygon(ring):
+    return {"type": "Polygon", "coordinates": [[list(point) for point in ring]]}
+
+
+def fetch_tiles(tiles, fetch, key=lambda result: result["id"], keep=None, workers=TILE_WORKERS):
+    """
+    Call fetch(tile) for each tile, up to `workers` at once, and return the
+    combined list of results in tile order, keeping only the first result
+    seen with each key. If given, keep(result) must also be true for a result
+    to be returned; it can be used to discard fields which were found by a
+    tile but lie outside the area originally asked for.
+    """
+    seen = set()
+    results = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for tile_results in executor.map(fetch, tiles):
+            for result in tile_results:
+                result_key = key(result)
+                if result_key in seen or (keep and not keep(result)):
+                    continue
+                seen.add(result_key)
+                results.append(result)
+
+    return results
@@ -0,0 +1,384 @@
+import atexit
+import bisect
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# Timing and tracing of the examples, to find where the time goes in a run:
+# in round trips to the API, in decoding responses, or in processing them.
+#
+# Work is recorded as spans: a named, timed piece of work with attributes
+# (a URL, a page count, a number of bytes) and, for API requests, the time
+# spent in each phase of the request (see PHASES). Spans started while
+# another is running on the same thread (or asyncio task) record it as
+# their parent; the running span is held in a context variable, which is
+# why the examples need Python 3.7 or later. Each finished span is passed
+# to every hook registered with add_hook. Two hooks are provided:
+# JsonLinesExporter writes each span as a line of JSON, and Summary
+# collects histograms of durations, phases and sizes by span name.
+#
+# Setting environment variables turns them on without changing any code:
+#
+#     $ export API_TRACE=trace.jsonl      # write every span to trace.jsonl
+#     $ export API_TRACE_SUMMARY=1        # print a summary when the run ends
+#
+# When no hooks are registered spans are still timed, but are otherwise
+# discarded.
+#
+# This module is shared by the examples of several directories, which add
+# this directory to sys.path before importing it.
+
+# Phases of an API request, in seconds: waiting for a free slot under the
+# client's concurrency limit, resolving the host name, opening the TCP
+# connection, the TLS handshake (these three only when a new connection is
+# made), waiting for the response headers once the connection is ready,
+# reading the body, decoding the JSON, and waiting before retries. Phases
+# repeated by retries are summed.
+PHASES = ["queue", "dns", "connect", "tls", "ttfb", "download", "decode", "backoff"]
+
+HOOKS = []
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.id = next(_span_ids)
+        parent = _current_span.get()
+        self.parent_id = parent.id if parent else None
+        self.attributes = attributes
+        self.timings = {}
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add_timing(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def increment(self, attribute, amount=1):
+        self.attributes[attribute] = self.attributes.get(attribute, 0) + amount
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "id": self.id,
+            "parentId": self.parent_id,
+            "start": self.start_time,
+            "duration": self.duration,
+            "thread": threading.current_thread().name,
+            "timings": self.timings,
+            **self.attributes,
+        }
+
+
+class span:
+    """
+    Time the code run within a `with` block as a span, e.g.
+
+        with tracing.span("get_data", url=url) as current:
+            ...
+            current.set(bytes=len(body))
+
+    The span is finished, and passed to the hooks, when the block exits. An
+    exception raised in the block is recorded as the span's error.
+    """
+
+    def __init__(self, name, **attributes):
+        self.span = Span(name, attributes)
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current_span.reset(self._token)
+        end(self.span, error=exc)
+
+
+class use_span:
+    """
+    Make a span started elsewhere the current span within a `with` block,
+    without ending it when the block exits.
+    """
+
+    def __init__(self, current):
+        self.span = current
+        self._token = None
+
+    def __enter__(self):
+        self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, traceback):
+        _current_span.reset(self._token)
+
+
+def end(finished_span, error=None):
+    """
+    Finish a span, recording the exception `error` if given, and pass it to
+    the hooks. Spans made with the span context manager are ended by it.
+    """
+    finished_span.duration = time.perf_counter() - finished_span.start
+    if error is not None:
+        finished_span.set(error=type(error).__name__)
+    finish(finished_span)
+
+
+def traced(function=None, name=None, count="items"):
+    """
+    Decorate a function (or coroutine function) so that each call is timed
+    as a span, named after the function unless a name is given. Generators
+    (and async generators) are timed until they are exhausted or closed,
+    with the number of items they yielded recorded as `count`, e.g. "pages".
+    A generator's span is not made the current span, as the generator runs
+    a piece at a time in its caller's context.
+    """
+    if function is None:
+        return functools.partial(traced, name=name, count=count)
+
+    span_name = name or function.__name__
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def traced_generator(*args, **kwargs):
+            current = Span(span_name, {count: 0})
+            error = None
+            try:
+                for item in function(*args, **kwargs):
+                    current.increment(count)
+                    yield item
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                end(current, error=error)
+        return traced_generator
+
+    if inspect.isasyncgenfunction(function):
+        @functools.wraps(function)
+        async def traced_async_generator(*args, **kwargs):
+            current = Span(span_name, {count: 0})
+            error = None
+            try:
+                async for item in function(*args, **kwargs):
+                    current.increment(count)
+                    yield item
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                end(current, error=error)
+        return traced_async_generator
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def traced_coroutine(*args, **kwargs):
+            with span(span_name):
+                return await function(*args, **kwargs)
+        return traced_coroutine
+
+    @functools.wraps(function)
+    def traced_function(*args, **kwargs):
+        with span(span_name):
+            return function(*args, **kwargs)
+    return traced_function
+
+
+def current_span():
+    """
+    Return the innermost span running on this thread or task, or None.
+    """
+    return _current_span.get()
+
+
+def add_hook(hook):
+    """
+    Register a callable to be passed each span as it finishes. Hooks are
+    called on the thread which ran the span, so must be thread-safe.
+    """
+    HOOKS.append(hook)
+    return hook
+
+
+def remove_hook(hook):
+    HOOKS.remove(hook)
+
+
+def enabled():
+    return bool(HOOKS)
+
+
+def finish(finished_span):
+    for hook in list(HOOKS):
+        hook(finished_span)
+
+
+class JsonLinesExporter:
+    """
+    A hook writing each span to a file as one line of JSON.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def __call__(self, finished_span):
+        line = json.dumps(finished_span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Histogram:
+    """
+    A histogram of positive values in logarithmic buckets, each bucket
+    BUCKETS_PER_DOUBLING times narrower than a doubling, from which
+    percentiles are estimated to within a few percent.
+    """
+
+    BUCKETS_PER_DOUBLING = 8
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        bucket = math.floor(math.log2(value) * self.BUCKETS_PER_DOUBLING) if value > 0 else None
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+
+    def upper_bound(self, bucket):
+        return 0.0 if bucket is None else 2 ** ((bucket + 1) / self.BUCKETS_PER_DOUBLING)
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        buckets = sorted(self.counts, key=lambda bucket: -math.inf if bucket is None else bucket)
+        cumulative = list(itertools.accumulate(self.counts[bucket] for bucket in buckets))
+        index = bisect.bisect_left(cumulative, percent / 100 * self.count)
+        return min(self.upper_bound(buckets[min(index, len(buckets) - 1)]), self.max)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else None,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "buckets": {str(self.upper_bound(bucket)): count for bucket, count in sorted(
+                self.counts.items(), key=lambda item: -math.inf if item[0] is None else item[0])},
+        }
+
+
+class Summary:
+    """
+    A hook collecting, for each span name, histograms of the spans'
+    durations, of each request phase, and of the bytes they transferred,
+    along with the number of pages and cache hits recorded.
+    """
+
+    # numeric span attributes which are summed (and histogrammed)
+    TOTALS = ["bytes", "wireBytes", "pages", "results", "items", "attempts"]
+
+    def __init__(self):
+        self.names = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, finished_span):
+        with self._lock:
+            summary = self.names.setdefault(finished_span.name, {"cacheHits": 0, "errors": 0, "histograms": {}})
+            histograms = summary["histograms"]
+            histograms.setdefault("duration", Histogram()).add(finished_span.duration)
+            for phase, seconds in finished_span.timings.items():
+                histograms.setdefault(phase, Histogram()).add(seconds)
+            for attribute in self.TOTALS:
+                value = finished_span.attributes.get(attribute)
+                if value is not None:
+                    histograms.setdefault(attribute, Histogram()).add(value)
+            if finished_span.attributes.get("cache") == "hit":
+                summary["cacheHits"] += 1
+            if finished_span.attributes.get("error"):
+                summary["errors"] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                name: {
+                    "cacheHits": summary["cacheHits"],
+                    "errors": summary["errors"],
+                    **{key: histogram.to_dict() for key, histogram in summary["histograms"].items()},
+                }
+                for name, summary in self.names.items()
+            }
+
+    def report(self, file=None):
+        """
+        Print a table of each span name's count and total time, and the
+        percentiles of its duration and request phases, in milliseconds.
+        """
+        file = file or sys.stderr
+        print(f"{'span':<40}{'count':>7}{'total s':>9}{'':>3}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'max ms':>9}", file=file)
+        for name, summary in sorted(self.to_dict().items(), key=lambda item: -item[1]["duration"]["total"]):
+            duration = summary["duration"]
+            print(f"{name:<40}{duration['count']:>7}{duration['total']:>9.2f}", file=file, end="")
+            extras = [f"{key}={summary[key]['total']:.0f}" for key in self.TOTALS if key in summary]
+            extras += [f"cacheHits={summary['cacheHits']}"] if summary["cacheHits"] else []
+            extras += [f"errors={summary['errors']}"] if summary["errors"] else []
+            for row, key in enumerate(["duration"] + [phase for phase in PHASES if phase in summary]):
+                histogram = summary[key]
+                label = "" if key == "duration" else f"  {key}"
+                prefix = "" if row == 0 else f"{label:<56}"
+                print(
+                    f"{prefix}{'':>3}{histogram['p50'] * 1000:>9.1f}{histogram['p90'] * 1000:>9.1f}"
+                    f"{histogram['p99'] * 1000:>9.1f}{histogram['max'] * 1000:>9.1f}",
+                    file=file,
+                )
+            if extras:
+                print(f"{'':<4}{' '.join(extras)}", file=file)
+
+
+def hooks_from_environment():
+    """
+    Register the hooks asked for by the API_TRACE (a JSON lines file to
+    write spans to) and API_TRACE_SUMMARY environment variables.
+    """
+    path = os.environ.get("API_TRACE")
+    if path:
+        exporter = add_hook(JsonLinesExporter(path))
+        atexit.register(exporter.close)
+
+    if os.environ.get("API_TRACE_SUMMARY"):
+        summary = add_hook(Summary())
+        atexit.register(summary.report)
+
+
+hooks_from_environment()
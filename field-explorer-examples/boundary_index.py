@@ -0,0 +1,373 @@
+import math
+import os
+
+import numpy
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# A local spatial index over field boundaries, for resolving points (or
+# areas) to fields without calling the API each time. Build one from the
+# GeoJSON features returned by field_boundaries.iter_field_boundaries or
+# fetch_all_results_as_geojson, for example:
+#
+#     index = BoundaryIndex.from_features(iter_field_boundaries(url, geojson=True))
+#     field_ids = index.find_fields(lons, lats)
+#
+# The boundaries are held in a handful of flat numpy arrays, with an R-tree
+# packed by the Sort-Tile-Recursive method over the fields' bounding boxes.
+# An index can be saved to a directory and loaded again memory-mapped, so
+# that an index larger than memory can be queried, and is shared between
+# processes through the page cache.
+
+# Maximum number of children of each node of the R-tree. Small nodes suit
+# the vectorised search below, which tests every child of each node it visits.
+NODE_SIZE = 4
+
+# Number of points looked up at once by find_fields. Larger chunks are
+# faster, but need more memory for the candidate fields of each point.
+POINT_CHUNK = 8192
+
+EARTH_RADIUS = 6371008.8  # mean radius, in metres
+
+ARRAYS = ["ids", "coords", "edges", "edge_offsets", "tree_boxes", "tree_order", "level_offsets"]
+
+
+class BoundaryIndex:
+    """
+    Field boundaries, indexed for point-in-field, within-polygon and
+    within-distance queries. Coordinates are (lon, lat) in degrees.
+
+    Arrays:
+      ids            the id of each field
+      coords         the vertices of every ring of every field, in order
+      edges          the index in coords of the first vertex of each edge,
+                     grouped by field
+      edge_offsets   the start of each field's edges in edges (one extra at
+                     the end)
+      tree_boxes     (min_lon, min_lat, max_lon, max_lat) of each node of the
+                     tree, level by level from the leaves (one per field,
+                     in field order) up to the root
+      tree_order     each level's nodes in Sort-Tile-Recursive order: the
+                     children of node i of the level above are nodes
+                     tree_order[i * node_size:(i + 1) * node_size] of the
+                     level below
+      level_offsets  the start of each level in tree_boxes and tree_order
+                     (one extra at the end)
+    """
+
+    def __init__(self, ids, coords, edges, edge_offsets, tree_boxes, tree_order, level_offsets, node_size=NODE_SIZE):
+        self.ids = ids
+        self.coords = coords
+        self.edges = edges
+        self.edge_offsets = edge_offsets
+        self.tree_boxes = tree_boxes
+        self.tree_order = tree_order
+        self.level_offsets = level_offsets
+        self.node_size = node_size
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_features(cls, features, node_size=NODE_SIZE):
+        """
+        Build an index from GeoJSON Polygon or MultiPolygon features, each
+        with an id property.
+        """
+        ids = []
+        coords = []
+        edges = []
+        edge_offsets = [0]
+
+        for feature in features:
+            geometry = feature["geometry"]
+            polygons = [geometry["coordinates"]] if geometry["type"] == "Polygon" else geometry["coordinates"]
+            for polygon in polygons:
+                for ring in polygon:
+                    # rings are closed, so each vertex but the last starts an edge
+                    edges.extend(range(len(coords), len(coords) + len(ring) - 1))
+                    coords.extend(ring)
+            edge_offsets.append(len(edges))
+            ids.append(feature["properties"]["id"])
+
+        coords = numpy.array(coords, dtype="float64").reshape(-1, 2)
+        edges = numpy.array(edges, dtype="int64")
+        edge_offsets = numpy.array(edge_offsets, dtype="int64")
+
+        tree_boxes, tree_order, level_offsets = pack_tree(field_boxes(coords, edges, edge_offsets), node_size)
+
+        return cls(numpy.array(ids, dtype="str"), coords, edges, edge_offsets, tree_boxes, tree_order, level_offsets, node_size)
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAYS:
+            numpy.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        numpy.save(os.path.join(directory, "node_size.npy"), numpy.array(self.node_size))
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Load an index saved with save(). Unless mmap is False, the arrays
+        are memory-mapped rather than read into memory.
+        """
+        mmap_mode = "r" if mmap else None
+        arrays = {name: numpy.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAYS}
+        node_size = int(numpy.load(os.path.join(directory, "node_size.npy")))
+        return cls(node_size=node_size, **arrays)
+
+    def find_field(self, lon, lat):
+        """
+        Return the id of the field containing a point, or None.
+        """
+        field_id = self.find_fields([lon], [lat])[0]
+        return field_id or None
+
+    def find_fields(self, lons, lats):
+        """
+        Return an array of the ids of the fields containing each point, with
+        an empty string for points which are not in any field.
+        """
+        lons = numpy.asarray(lons, dtype="float64")
+        lats = numpy.asarray(lats, dtype="float64")
+        found = numpy.full(len(lons), -1, dtype="int64")
+
+        for start in range(0, len(lons), POINT_CHUNK):
+            x = lons[start:start + POINT_CHUNK]
+            y = lats[start:start + POINT_CHUNK]
+            points, fields = self.search(numpy.stack([x, y, x, y], axis=1))
+
+            inside = self.contains(fields, x[points], y[points])
+            # where fields overlap, the point is given to one of them
+            found[start + points[inside]] = fields[inside]
+
+        if len(self) == 0:
+            return numpy.full(len(lons), "")
+
+        ids = numpy.asarray(self.ids)
+        return numpy.where(found >= 0, ids[numpy.maximum(found, 0)], "")
+
+    def fields_within(self, polygon):
+        """
+        Return the ids of the fields lying entirely within a polygon, given
+        as a list of (lon, lat) points.
+        """
+        ring = numpy.asarray(polygon, dtype="float64")
+        box = numpy.concatenate([ring.min(axis=0), ring.max(axis=0)])
+        _, fields = self.search(box[numpy.newaxis, :])
+
+        within = []
+        for field in fields:
+            vertices = self.coords[self.edges[self.edge_offsets[field]:self.edge_offsets[field + 1]]]
+            if points_in_ring(vertices, ring).all() and not edges_cross(self.field_edges(field), ring):
+                within.append(field)
+
+        return [str(self.ids[field]) for field in sorted(within)]
+
+    def fields_intersecting(self, polygon):
+        """
+        Return the ids of the fields which overlap a polygon, given as a list
+        of (lon, lat) points.
+        """
+        ring = numpy.asarray(polygon, dtype="float64")
+        box = numpy.concatenate([ring.min(axis=0), ring.max(axis=0)])
+        _, fields = self.search(box[numpy.newaxis, :])
+
+        intersecting = []
+        for field in fields:
+            vertices = self.coords[self.edges[self.edge_offsets[field]:self.edge_offsets[field + 1]]]
+            # a field overlaps the polygon if it has a vertex inside it, it
+            # contains the polygon, or their edges cross
+            if (points_in_ring(vertices, ring).any()
+                    or self.contains(numpy.array([field]), ring[:1, 0], ring[:1, 1])[0]
+                    or edges_cross(self.field_edges(field), ring)):
+                intersecting.append(field)
+
+        return [str(self.ids[field]) for field in sorted(intersecting)]
+
+    def fields_within_distance(self, lon, lat, distance):
+        """
+        Return the ids of the fields any part of which lies within `distance`
+        metres of a point. Distances are measured on a plane tangent to the
+        point, which is accurate to well under a metre over a few kilometres.
+        """
+        d_lat = math.degrees(distance / EARTH_RADIUS)
+        d_lon = d_lat / max(math.cos(math.radians(lat)), 1e-6)
+        box = numpy.array([[lon - d_lon, lat - d_lat, lon + d_lon, lat + d_lat]])
+        _, fields = self.search(box)
+
+        metres_per_degree = math.radians(1) * EARTH_RADIUS
+        scale = numpy.array([metres_per_degree * math.cos(math.radians(lat)), metres_per_degree])
+        near = []
+        for field in fields:
+            segments = (self.field_edges(field) - [lon, lat, lon, lat]) * numpy.tile(scale, 2)
+            inside = self.contains(numpy.array([field]), numpy.array([lon]), numpy.array([lat]))[0]
+            if inside or segment_distances(segments).min() <= distance:
+                near.append(field)
+
+        return [str(self.ids[field]) for field in sorted(near)]
+
+    def search(self, boxes):
+        """
+        Return (query, field) index pairs for every field whose bounding box
+        intersects each query box, walking the tree one level at a time for
+        all the query boxes at once.
+        """
+        boxes = numpy.asarray(boxes, dtype="float64")
+        if len(self) == 0:
+            return numpy.zeros(0, dtype="int64"), numpy.zeros(0, dtype="int64")
+
+        levels = len(self.level_offsets) - 1
+        queries = numpy.arange(len(boxes))
+        nodes = numpy.zeros(len(boxes), dtype="int64")
+
+        for level in range(levels - 1, -1, -1):
+            level_boxes = self.tree_boxes[self.level_offsets[level]:self.level_offsets[level + 1]]
+            # (numpy.take gathers rows much faster than fancy indexing)
+            node_boxes = numpy.take(level_boxes, nodes, axis=0)
+            query_boxes = numpy.take(boxes, queries, axis=0)
+            hit = node_boxes[:, 0] <= query_boxes[:, 2]
+            hit &= query_boxes[:, 0] <= node_boxes[:, 2]
+            hit &= node_boxes[:, 1] <= query_boxes[:, 3]
+            hit &= query_boxes[:, 1] <= node_boxes[:, 3]
+            queries, nodes = queries[hit], nodes[hit]
+
+            if level > 0:
+                positions = (nodes[:, numpy.newaxis] * self.node_size + numpy.arange(self.node_size)).ravel()
+                queries = numpy.repeat(queries, self.node_size)
+                exists = positions < self.level_offsets[level] - self.level_offsets[level - 1]
+                queries = queries[exists]
+                nodes = self.tree_order[self.level_offsets[level - 1] + positions[exists]]
+
+        return queries, nodes
+
+    def contains(self, fields, x, y):
+        """
+        For each (field, x, y), whether the point lies within the field,
+        counting crossings of a ray from the point over all of the field's
+        edges (so holes and multi-part fields are handled alike).
+        """
+        starts = self.edge_offsets[fields]
+        counts = self.edge_offsets[fields + 1] - starts
+        pairs = numpy.repeat(numpy.arange(len(fields)), counts)
+        positions = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        edges = self.edges[starts[pairs] + positions]
+
+        start = numpy.take(self.coords, edges, axis=0)
+        end = numpy.take(self.coords, edges + 1, axis=0)
+        x1, y1, x2, y2 = start[:, 0], start[:, 1], end[:, 0], end[:, 1]
+        px, py = x[pairs], y[pairs]
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            crosses = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+
+        return numpy.bincount(pairs, weights=crosses, minlength=len(fields)) % 2 == 1
+
+    def field_edges(self, field):
+        """
+        The edges of a field as an array of (x1, y1, x2, y2) rows.
+        """
+        edges = self.edges[self.edge_offsets[field]:self.edge_offsets[field + 1]]
+        return numpy.concatenate([self.coords[edges], self.coords[edges + 1]], axis=1)
+
+
+def field_boxes(coords, edges, edge_offsets):
+    # every vertex starts an edge (rings being closed), so the first vertices
+    # of a field's edges are all of its vertices
+    boxes = numpy.tile([numpy.inf, numpy.inf, -numpy.inf, -numpy.inf], (len(edge_offsets) - 1, 1))
+    starts = edge_offsets[:-1]
+    has_edges = starts < edge_offsets[1:]
+
+    if has_edges.any():
+        vertices = coords[edges]
+        boxes[has_edges, :2] = numpy.minimum.reduceat(vertices, starts[has_edges])
+        boxes[has_edges, 2:] = numpy.maximum.reduceat(vertices, starts[has_edges])
+
+    # fields without a boundary keep an empty box, and so are never found
+    return boxes
+
+
+def str_order(boxes, node_size):
+    """
+    Order boxes for Sort-Tile-Recursive packing: sorted by the x of their
+    centres into vertical slices, then by y within each slice, so that each
+    run of node_size boxes is a compact tile.
+    """
+    count = len(boxes)
+    if count == 0:
+        return numpy.zeros(0, dtype="int64")
+
+    centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+    centres[~numpy.isfinite(centres)] = 0
+    slices = math.ceil(math.sqrt(math.ceil(count / node_size)))
+    slice_size = slices * node_size
+
+    by_x = numpy.argsort(centres[:, 0], kind="stable")
+    slice_of = numpy.arange(count) // slice_size
+    return by_x[numpy.lexsort((centres[by_x, 1], slice_of))]
+
+
+def pack_tree(leaf_boxes, node_size):
+    """
+    Build the tree level by level from the leaves: each level's nodes are
+    put in Sort-Tile-Recursive order and each run of node_size of them is
+    covered by one node of the level above. Returns the boxes and order of
+    all the levels, leaves first, and the offset of each level.
+    """
+    levels = [leaf_boxes]
+    orders = []
+    while True:
+        below = levels[-1]
+        order = str_order(below, node_size)
+        orders.append(order)
+        if len(below) <= 1:
+            break
+
+        starts = numpy.arange(0, len(below), node_size)
+        sorted_boxes = below[order]
+        levels.append(numpy.concatenate([
+            numpy.minimum.reduceat(sorted_boxes[:, :2], starts),
+            numpy.maximum.reduceat(sorted_boxes[:, 2:], starts),
+        ], axis=1))
+
+    offsets = numpy.cumsum([0] + [len(level) for level in levels])
+    return numpy.concatenate(levels).reshape(-1, 4), numpy.concatenate(orders), offsets
+
+
+def points_in_ring(points, ring):
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    px, py = points[:, 0:1], points[:, 1:2]
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        crosses = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+
+    return crosses.sum(axis=1) % 2 == 1
+
+
+def edges_cross(edges, ring):
+    """
+    Whether any of the edges (x1, y1, x2, y2) properly crosses an edge of the ring.
+    """
+    a, b = edges[:, numpy.newaxis, :2], edges[:, numpy.newaxis, 2:]
+    c, d = ring[numpy.newaxis, :-1], ring[numpy.newaxis, 1:]
+
+    def orientation(p, q, r):
+        return numpy.sign((q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) - (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0]))
+
+    return bool(((orientation(a, b, c) * orientation(a, b, d) < 0) & (orientation(c, d, a) * orientation(c, d, b) < 0)).any())
+
+
+def segment_distances(segments):
+    """
+    Distance from the origin to each segment (x1, y1, x2, y2).
+    """
+    p = segments[:, :2]
+    direction = segments[:, 2:] - p
+    length_squared = (direction ** 2).sum(axis=1)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t = numpy.where(length_squared > 0, -(p * direction).sum(axis=1) / length_squared, 0)
+    nearest = p + numpy.clip(t, 0, 1)[:, numpy.newaxis] * direction
+    return numpy.hypot(nearest[:, 0], nearest[:, 1])
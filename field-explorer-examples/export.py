@@ -0,0 +1,179 @@
+import os
+import struct
+
+import pandas
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+    import pyarrow.fs
+except ImportError:
+    pyarrow = None
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# Exporting results as columnar datasets, rather than printing them, so that
+# they can be loaded again (by pandas, Spark, DuckDB and so on) reading only
+# the columns and partitions needed, without re-parsing JSON.
+#
+# Tables are written as datasets of Parquet files, or of Arrow IPC (Feather
+# v2) files, which can be memory-mapped and read without copying. Datasets
+# are partitioned into directories by column values in the Hive style, e.g.
+# rainfall/fieldId=.../year=2020/part-0.parquet. Field boundaries are stored
+# as WKB (well-known binary) geometries.
+#
+# Writing needs pyarrow, which is not needed by the rest of the examples:
+#
+#     $ pip install pyarrow
+
+FORMATS = {
+    "parquet": "parquet",
+    "arrow": "ipc",
+}
+
+# How each kind of table is partitioned by default.
+PARTITIONS = {
+    "rainfall": ["fieldId", "year"],
+    "temperature": ["fieldId", "year"],
+    "weather": ["fieldId", "year"],
+    "soil": ["fieldId"],
+    "boundaries": ["fieldId"],
+}
+
+
+def write_dataset(dataframe, path, partition_by=None, format="parquet"):
+    """
+    Write a DataFrame as a dataset at `path`, partitioned by the columns in
+    partition_by. A DataFrame indexed by time is given a year column, so
+    that it can be partitioned by year, and its index is kept as a date
+    column. Existing files in the dataset are replaced.
+    """
+    require_pyarrow()
+
+    dataframe = with_date_column(with_year_column(dataframe))
+    table = pyarrow.Table.from_pandas(dataframe, preserve_index=False)
+
+    pyarrow.dataset.write_dataset(
+        table,
+        path,
+        format=FORMATS[format],
+        partitioning=partition_by or None,
+        partitioning_flavor="hive" if partition_by else None,
+        existing_data_behavior="delete_matching",
+    )
+
+
+def read_dataset(path, columns=None, filter=None, format="parquet"):
+    """
+    Read a dataset written by write_dataset as a pyarrow Table, reading only
+    the given columns and the partitions matching filter, e.g.
+    pyarrow.dataset.field("year") == 2020. Arrow IPC files are memory-mapped.
+    """
+    require_pyarrow()
+
+    filesystem = pyarrow.fs.LocalFileSystem(use_mmap=format == "arrow")
+    dataset = pyarrow.dataset.dataset(path, format=FORMATS[format], partitioning="hive", filesystem=filesystem)
+    return dataset.to_table(columns=columns, filter=filter)
+
+
+def write_tables(tables, directory, format="parquet"):
+    """
+    Write each of a dict of named DataFrames (such as the batch tables of
+    field_explorer) as a dataset in `directory`, partitioned as in PARTITIONS.
+    """
+    for name, dataframe in tables.items():
+        dataframe = with_year_column(dataframe)
+        partition_by = [column for column in PARTITIONS.get(name, []) if column in dataframe.columns]
+        write_dataset(dataframe, os.path.join(directory, name), partition_by=partition_by, format=format)
+
+
+def with_year_column(dataframe):
+    if "year" in dataframe.columns or not isinstance(dataframe.index, pandas.DatetimeIndex):
+        return dataframe
+    return dataframe.assign(year=dataframe.index.year)
+
+
+def with_date_column(dataframe):
+    """
+    Move the index of a DataFrame indexed by time into a date column, as
+    writers which leave out the index would otherwise lose it.
+    """
+    if not isinstance(dataframe.index, pandas.DatetimeIndex):
+        return dataframe
+    return dataframe.rename_axis("date").reset_index()
+
+
+def boundaries_to_dataframe(features):
+    """
+    One row per GeoJSON feature: its properties as columns (fieldId for its
+    id) and its geometry as WKB in a geometry column.
+    """
+    rows = []
+    for feature in features:
+        properties = dict(feature.get("properties") or {})
+        properties["fieldId"] = properties.pop("id", None)
+        properties["geometry"] = geojson_to_wkb(feature["geometry"])
+        rows.append(properties)
+
+    return pandas.DataFrame(rows, columns=None if rows else ["fieldId", "geometry"])
+
+
+# WKB encoding of GeoJSON geometries (little-endian, 2D).
+
+WKB_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+    "GeometryCollection": 7,
+}
+
+
+def geojson_to_wkb(geometry):
+    return b"".join(wkb_parts(geometry))
+
+
+def wkb_parts(geometry):
+    geometry_type = geometry["type"]
+    yield struct.pack("<BI", 1, WKB_TYPES[geometry_type])
+
+    if geometry_type == "GeometryCollection":
+        yield struct.pack("<I", len(geometry["geometries"]))
+        for member in geometry["geometries"]:
+            yield from wkb_parts(member)
+        return
+
+    coordinates = geometry["coordinates"]
+    if geometry_type == "Point":
+        yield wkb_point(coordinates)
+    elif geometry_type == "LineString":
+        yield wkb_points(coordinates)
+    elif geometry_type == "Polygon":
+        yield wkb_rings(coordinates)
+    else:
+        member_type = geometry_type[len("Multi"):]
+        yield struct.pack("<I", len(coordinates))
+        for member in coordinates:
+            yield from wkb_parts({"type": member_type, "coordinates": member})
+
+
+def wkb_point(point):
+    return struct.pack("<2d", *point[:2])
+
+
+def wkb_points(points):
+    return struct.pack(f"<I{2 * len(points)}d", len(points), *(value for point in points for value in point[:2]))
+
+
+def wkb_rings(rings):
+    return struct.pack("<I", len(rings)) + b"".join(wkb_points(ring) for ring in rings)
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ImportError("Exporting to Parquet or Arrow needs pyarrow: pip install pyarrow")
@@ -1,19 +1,35 @@
 #!/bin/python3
 
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 import urllib
 
 import json
 
+# the shared API client, tracing and tiling modules are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import api_client
+import tiling
+import tracing
+from boundary_index import BoundaryIndex
+
 
 API_KEY = os.environ.get("API_KEY") or exit('API_KEY environment variable required')
 BASE_URL = "https://api.agrimetrics.co.uk/field-boundaries"
 
+# Number of pages requested ahead of the page being processed. Up to
+# PREFETCH_PAGES - 1 requests may be made past the last page of results.
+PREFETCH_PAGES = 4
+
 # Please note, these examples require an Agrimetrics subscription with premium credits.
 # Running these examples for the first time will consume 6 premium credits,
-# subsequent runs will not consume any more credits.
+# subsequent runs will not consume any more credits. The shape in
+# get_all_field_boundaries_for_shape fits in one tile, for which the fields
+# in its bounding box are fetched; a larger shape is queried a tile at a
+# time, and costs more.
 
 
 def main():
@@ -23,12 +39,18 @@ def main():
 
 
 def get_all_field_boundaries_for_shape():
-    shape = "POLYGON((-0.35791397094726557 51.80370566913594,-0.3737926483154297 51.81853742720025,-0.38396358489990234 51.8139477982038,-0.3879976272583008 51.802246108975304,-0.36383628845214844 51.79999033214456,-0.35791397094726557 51.80370566913594))"
+    shape = [
+        (-0.35791397094726557, 51.80370566913594),
+        (-0.3737926483154297, 51.81853742720025),
+        (-0.38396358489990234, 51.8139477982038),
+        (-0.3879976272583008, 51.802246108975304),
+        (-0.36383628845214844, 51.79999033214456),
+        (-0.35791397094726557, 51.80370566913594),
+    ]
 
-    url = f"{BASE_URL}?geometry={urllib.parse.quote(shape)}&op=within"
-    print(f"\nBoundaries by shape URL (first page): {url}")
+    print("\nBoundaries by shape")
 
-    all_results = fetch_all_results(url)
+    all_results = fetch_all_results_for_polygon(shape, op="within")
 
     print(f"Total results retrieved: {len(all_results)}")
     print(f"The first field id: {all_results[0]['id']}")
@@ -51,6 +73,12 @@ def get_all_field_boundaries_within_radius_as_geojson_feature_collection():
     print("The last field boundary (as GeoJSON Feature):")
     print(json.dumps(feature_collection['features'][-1], indent=2))
 
+    # the downloaded boundaries can answer further questions about the area
+    # locally, without calling the API again (see boundary_index.py)
+    index = BoundaryIndex.from_features(feature_collection['features'])
+    print(f"The field containing the centre point (found locally): {index.find_field(*point)}")
+    print(f"Fields within 100m of the centre point (found locally): {index.fields_within_distance(*point, 100)}")
+
 
 def get_field_boundary_by_field_id_as_geojson_feature():
     field_id = "C6BgTxUxhMG_OCGrLGW8qw"
@@ -65,46 +93,19 @@ def get_field_boundary_by_field_id_as_geojson_feature():
 # get all pages of results.
 # We know that we have got all results when receive a page
 # which has fewer than pageSize results.
-def fetch_all_results(url, pageSize=100):
-    pageNum = 1
-    all_results = []
-    while True:
-        pageUrl = f"{url}&pageSize={pageSize}&pageNum={pageNum}"
-        print(f"\tPage {pageNum} URL: {pageUrl}")
-
-        response = get_data(url=pageUrl)
-
-        page_of_results = response['results']
-        all_results = all_results + page_of_results
-
-        if len(page_of_results) < pageSize:
-            print("\tReached last page of of results")
-            break
-
-        pageNum = pageNum + 1
+def fetch_all_results(url, pageSize=100, window=PREFETCH_PAGES):
+    all_results = list(iter_field_boundaries(url, pageSize=pageSize, window=window))
 
+    print("\tReached last page of of results")
     return all_results
 
 # get all pages of GeoJSON FeatureCollection results.
 # We know that we have got all results when receive a page
 # which has fewer than pageSize features.
-def fetch_all_results_as_geojson(url, pageSize=100):
-    pageNum = 1
-    all_features = []
-    while True:
-        pageUrl = f"{url}&pageSize={pageSize}&pageNum={pageNum}"
-        print(f"\tPage {pageNum} URL: {pageUrl}")
-
-        response = get_data(url=pageUrl, geojson=True)
-
-        page_of_features = response['features']
-        all_features = all_features + page_of_features
-
-        if len(page_of_features) < pageSize:
-            print("\tReached last page of of features")
-            break
+def fetch_all_results_as_geojson(url, pageSize=100, window=PREFETCH_PAGES):
+    all_features = list(iter_field_boundaries(url, pageSize=pageSize, geojson=True, window=window))
 
-        pageNum = pageNum + 1
+    print("\tReached last page of of features")
 
     # return re-built GeoJSON FeatureCollection structure
     return {
@@ -113,6 +114,102 @@ def fetch_all_results_as_geojson(url, pageSize=100):
     }
 
 
+# get all results (or GeoJSON features) for the fields within a polygon,
+# given as a list of (lon, lat) points, or intersecting it if op is
+# "intersects". Rather than paging through one query over the whole
+# polygon, the polygon is split into tiles (see tiling.py) which are
+# queried in parallel, and fields found in more than one tile are merged.
+# Each tile is small, so its pages are fetched one at a time.
+#
+# A field within the polygon may cross the edge of a tile, so the tiles are
+# asked for the fields which intersect them, and the fields are then tested
+# against the whole polygon locally (see boundary_index.py). The result is
+# the same set of fields as one query over the polygon, though the fields
+# near it which are found by a tile and then discarded are paid for too.
+def fetch_all_results_for_polygon(polygon, op="within", pageSize=100, geojson=False, tile_size=tiling.TILE_SIZE):
+    tiles = tiling.polygon_tiles(polygon, tile_size=tile_size)
+    print(f"\tQuerying {len(tiles)} tiles")
+
+    def fetch_tile(tile):
+        url = f"{BASE_URL}?geometry={urllib.parse.quote(tiling.wkt_polygon(tile))}&op=intersects"
+        return list(iter_field_boundaries(url, pageSize=pageSize, geojson=geojson, window=1))
+
+    key = field_id_of_feature if geojson else field_id_of_result
+    results = tiling.fetch_tiles(tiles, fetch_tile, key=key)
+
+    index = BoundaryIndex.from_features(results if geojson else map(result_to_feature, results))
+    matching = set(index.fields_within(polygon) if op == "within" else index.fields_intersecting(polygon))
+    return [result for result in results if key(result) in matching]
+
+
+def field_id_of_result(result):
+    return result['id']
+
+
+def field_id_of_feature(feature):
+    return feature['properties']['id']
+
+
+def result_to_feature(result):
+    return {'type': 'Feature', 'properties': {'id': result['id']}, 'geometry': result['boundary']}
+
+
+# yield results (or GeoJSON features) one at a time, fetching a page at a time.
+# Only the pages currently being fetched are held in memory, so very large
+# areas can be streamed to disk (see write_geojson_feature_collection).
+def iter_field_boundaries(url, pageSize=100, geojson=False, window=PREFETCH_PAGES):
+    for page in fetch_pages(url, pageSize=pageSize, geojson=geojson, window=window):
+        yield from page
+
+
+# write GeoJSON features to an open file as a FeatureCollection, one feature
+# at a time, without building the whole collection in memory first.
+def write_geojson_feature_collection(features, file):
+    file.write('{"type": "FeatureCollection", "features": [')
+    for i, feature in enumerate(features):
+        if i:
+            file.write(',')
+        file.write('\n')
+        json.dump(feature, file)
+    file.write('\n]}\n')
+
+
+# yield pages of results (or GeoJSON features) in page order, keeping up to
+# `window` page requests in flight at once. The first page which has fewer
+# than pageSize items marks the end of the data: any requests still
+# outstanding for later pages are cancelled, or discarded if already running.
+@tracing.traced(count="pages")
+def fetch_pages(url, pageSize=100, geojson=False, window=PREFETCH_PAGES):
+    key = 'features' if geojson else 'results'
+    executor = ThreadPoolExecutor(max_workers=window)
+    pending = {}
+
+    def request_page(pageNum):
+        pageUrl = f"{url}&pageSize={pageSize}&pageNum={pageNum}"
+        print(f"\tPage {pageNum} URL: {pageUrl}")
+        pending[pageNum] = executor.submit(get_data, url=pageUrl, geojson=geojson)
+
+    try:
+        for pageNum in range(1, window + 1):
+            request_page(pageNum)
+
+        pageNum = 1
+        while True:
+            page = pending.pop(pageNum).result()[key]
+            yield page
+
+            if len(page) < pageSize:
+                break
+
+            request_page(pageNum + window)
+            pageNum = pageNum + 1
+    finally:
+        for future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+@tracing.traced
 def get_data(url, geojson=False):
     headers = {
       'Ocp-Apim-Subscription-Key': API_KEY
@@ -120,9 +217,7 @@ def get_data(url, geojson=False):
     if geojson:
         headers["accept"] = "application/geo+json"
 
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return api_client.get_json(url=url, headers=headers)
 
 
 if __name__ == '__main__':
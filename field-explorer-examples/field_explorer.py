@@ -1,17 +1,47 @@
 #!/bin/python3
 
+import argparse
 import os
-from datetime import date
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 import pandas
+import requests
+
+# the shared API client, tracing and tiling modules are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
 
+import api_client
+import export
+import tracing
 from plotting import plot_timeseries
 
 API_KEY = os.environ.get("API_KEY") or exit('API_KEY environment variable required')
 
+# Number of API calls made at once in batch mode.
+BATCH_WORKERS = api_client.POOL_SIZE
+
+# Points are rounded to this many decimal places (about 0.1m) before they
+# are deduplicated in batch mode, so that a location written to different
+# precisions is looked up once.
+COORDINATE_DECIMALS = 6
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Explore the data for a field, or for the fields containing a batch of points.")
+    parser.add_argument("points", nargs="?", help="CSV or Parquet file of points, with lat and lon columns")
+    parser.add_argument("--output", help="directory to write the tables to, in batch mode")
+    parser.add_argument("--format", choices=["csv", "parquet", "arrow"], default="csv",
+                        help="write each table as a CSV file, or as a partitioned Parquet or Arrow dataset (needs pyarrow)")
+    args = parser.parse_args()
+
+    if args.points:
+        batch(args.points, output=args.output, format=args.format)
+    else:
+        explore_field()
+
+
+def explore_field():
     coordinates = {
         "lat": 51.801963734,
         "lon": -0.363389293,
@@ -26,15 +56,10 @@ def main():
     process_field_facts_soil(field_response)
 
 
+@tracing.traced
 def process_field_trends_rainfall(field_finder_response):
     # Monthly Rainfall
-    field_trends_url = get_api_url(field_finder_response, 'field-trends')
-    print(f"\nField Trends URL: {field_trends_url}")
-
-    trends_result = get_data(field_trends_url)
-    monthly_rainfall = json_to_dataframe(trends_result['hasMonthlyTotalRainfall']['hasDatapoint'])
-    monthly_rainfall = monthly_rainfall[['year', 'month', 'value']].copy()
-    monthly_rainfall = convert_year_month_columns_to_date(monthly_rainfall)
+    monthly_rainfall = get_field_trends_rainfall(field_finder_response)
 
     plot_timeseries(monthly_rainfall, title='Monthly rainfall for last 3 years')
 
@@ -44,16 +69,11 @@ def process_field_trends_rainfall(field_finder_response):
     print(monthly_rainfall.to_string(index=False))
 
 
+@tracing.traced
 def process_field_forecasts_temperature(field_finder_response):
 
     # Get daily maximum temperatures
-    field_forecasts_url = get_api_url(field_finder_response, 'field-forecasts')
-    print(f"\nField Forecasts URL: {field_forecasts_url}")
-
-    forecast_result = get_data(field_forecasts_url)
-    daily_forecast_maximum_temperature = json_to_dataframe(forecast_result['hasForecastDailyMaximumTemperature']['hasDatapoint'])
-    daily_forecast_maximum_temperature = daily_forecast_maximum_temperature[['dateTime', 'value']].copy()
-    daily_forecast_maximum_temperature = convert_dateTime_columns_to_datetime(daily_forecast_maximum_temperature)
+    daily_forecast_maximum_temperature = get_field_forecasts_temperature(field_finder_response)
 
     plot_timeseries(daily_forecast_maximum_temperature, title='Daily Maximum Temperature')
 
@@ -61,10 +81,41 @@ def process_field_forecasts_temperature(field_finder_response):
     print(daily_forecast_maximum_temperature.to_string(index=False))
 
 
+@tracing.traced
 def process_field_facts_soil(field_finder_response):
     # Soil layers
+    soil_layers = get_field_facts_soil(field_finder_response)
+
+    print('\nSoil Layers')
+    print(soil_layers.to_string(index=False))
+
+
+def get_field_trends_rainfall(field_finder_response, verbose=True):
+    field_trends_url = get_api_url(field_finder_response, 'field-trends')
+    if verbose:
+        print(f"\nField Trends URL: {field_trends_url}")
+
+    trends_result = get_data(field_trends_url)
+    monthly_rainfall = json_to_dataframe(trends_result['hasMonthlyTotalRainfall']['hasDatapoint'])
+    monthly_rainfall = monthly_rainfall[['year', 'month', 'value']].copy()
+    return convert_year_month_columns_to_date(monthly_rainfall)
+
+
+def get_field_forecasts_temperature(field_finder_response, verbose=True):
+    field_forecasts_url = get_api_url(field_finder_response, 'field-forecasts')
+    if verbose:
+        print(f"\nField Forecasts URL: {field_forecasts_url}")
+
+    forecast_result = get_data(field_forecasts_url)
+    daily_forecast_maximum_temperature = json_to_dataframe(forecast_result['hasForecastDailyMaximumTemperature']['hasDatapoint'])
+    daily_forecast_maximum_temperature = daily_forecast_maximum_temperature[['dateTime', 'value']].copy()
+    return convert_dateTime_columns_to_datetime(daily_forecast_maximum_temperature)
+
+
+def get_field_facts_soil(field_finder_response, verbose=True):
     field_facts_url = get_api_url(field_finder_response, 'field-facts')
-    print(f"\nField Facts URL: {field_facts_url}")
+    if verbose:
+        print(f"\nField Facts URL: {field_facts_url}")
 
     facts_result = get_data(field_facts_url)
 
@@ -82,18 +133,121 @@ def process_field_facts_soil(field_finder_response):
     )
     soil_layers = soil_layers[['Layer', 'Sand %', 'Clay %', 'Silt %']].copy()
     soil_layers['Layer'] = soil_layers['Layer'].apply(lambda x: x.replace('http://data.agrimetrics.co.uk/soil-layer-types/',''))
-
-    print('\nSoil Layers')
-    print(soil_layers.to_string(index=False))
+    return soil_layers
+
+
+# Batch mode: resolve every point in a file to its field, then fetch the
+# trends, forecasts and facts of each distinct field once, with up to
+# BATCH_WORKERS calls in flight at once. Each kind of data is gathered into
+# one table, with a fieldId column, rather than printed field by field. A
+# call which fails does not stop the batch: the failure is recorded in an
+# errors table, and the rest of the results are kept.
+BATCH_TABLES = {
+    'rainfall': get_field_trends_rainfall,
+    'temperature': get_field_forecasts_temperature,
+    'soil': get_field_facts_soil,
+}
+
+
+def batch(points_file, output=None, format="csv", workers=BATCH_WORKERS):
+    points = read_points(points_file)
+    print(f"Read {len(points)} points from {points_file}")
+
+    tables = batch_explore_fields(points, workers=workers)
+
+    for name, table in tables.items():
+        print(f"\n{name}: {len(table)} rows")
+        # tables of time series are indexed by date, which is written as a column
+        table = export.with_date_column(table)
+        print(table.head().to_string(index=False))
+
+        if output and format == "csv":
+            os.makedirs(output, exist_ok=True)
+            path = os.path.join(output, f"{name}.csv")
+            table.to_csv(path, index=False)
+            print(f"Written to {path}")
+
+    # Parquet and Arrow datasets are partitioned by field (and year)
+    if output and format != "csv":
+        export.write_tables(tables, output, format=format)
+        print(f"\nWritten as {format} datasets to {output}")
+
+    return tables
+
+
+def read_points(path):
+    if path.endswith('.parquet'):
+        # needs pyarrow (or fastparquet) to be installed
+        return pandas.read_parquet(path)
+    return pandas.read_csv(path)
+
+
+@tracing.traced
+def batch_explore_fields(points, workers=BATCH_WORKERS):
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # each distinct location is looked up once
+        locations = points[['lat', 'lon']].round(COORDINATE_DECIMALS)
+        coordinates = locations.drop_duplicates()
+        finder_futures = [
+            executor.submit(find_field_or_none, {'lat': lat, 'lon': lon})
+            for lat, lon in coordinates.itertuples(index=False)
+        ]
+
+        field_responses = []
+        for (lat, lon), future in zip(coordinates.itertuples(index=False), finder_futures):
+            try:
+                field_responses.append(future.result())
+            except Exception as e:
+                field_responses.append(None)
+                errors.append({'lat': lat, 'lon': lon, 'fieldId': None, 'table': 'fields',
+                               'error': f"Failed to find the field at {lat}, {lon}: {e}"})
+
+        coordinates = coordinates.assign(fieldId=[response and response['@id'] for response in field_responses])
+        fields = points.assign(fieldId=locations.merge(coordinates, on=['lat', 'lon'], how='left')['fieldId'].to_numpy())
+        print(f"Found {fields.fieldId.nunique()} distinct fields for {len(coordinates)} distinct points")
+
+        # ...and each distinct field is explored once, all its calls at once
+        field_responses = {response['@id']: response for response in field_responses if response}
+        data_futures = {
+            (name, field_id): executor.submit(get_table, response, verbose=False)
+            for field_id, response in field_responses.items()
+            for name, get_table in BATCH_TABLES.items()
+        }
+
+        tables = {'fields': fields}
+        for name in BATCH_TABLES:
+            field_tables = []
+            for field_id in field_responses:
+                try:
+                    field_tables.append(data_futures[name, field_id].result().assign(fieldId=field_id))
+                except Exception as e:
+                    errors.append({'lat': None, 'lon': None, 'fieldId': field_id, 'table': name,
+                                   'error': f"Failed to get {name} data for {field_id}: {e}"})
+            tables[name] = pandas.concat(field_tables) if field_tables else pandas.DataFrame(columns=['fieldId'])
+
+    if errors:
+        print(f"{len(errors)} calls failed, see the errors table")
+    tables['errors'] = pandas.DataFrame(errors, columns=['lat', 'lon', 'fieldId', 'table', 'error'])
+    return tables
+
+
+def find_field_or_none(coordinates):
+    try:
+        return find_field(coordinates)
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise
 
 
+@tracing.traced
 def get_data(url):
     headers = {
       'Ocp-Apim-Subscription-Key': API_KEY
     }
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return api_client.get_json(url=url, headers=headers)
 
 
 def find_field(coordinates):
@@ -106,11 +260,19 @@ def get_api_url(field_response, field_api):
 
 
 def json_to_dataframe(data):
-    return pandas.io.json.json_normalize(data)
+    return pandas.json_normalize(data)
 
 
 def convert_year_month_columns_to_date(dataframe):
-    dataframe.index = pandas.to_datetime(dataframe.apply(lambda x: datapoint_date_to_date(x), axis=1))
+    # index by the first day of each datapoint's month, built from the whole
+    # year and month columns at once; datapoints without them have a dateTime
+    if 'year' in dataframe.columns and 'month' in dataframe.columns:
+        years = dataframe['year'].astype('int64').to_numpy()
+        months = dataframe['month'].astype('int64').to_numpy()
+        months_since_epoch = (years - 1970) * 12 + (months - 1)
+        dataframe.index = pandas.DatetimeIndex(months_since_epoch.astype('datetime64[M]').astype('datetime64[ns]'))
+    else:
+        dataframe.index = pandas.to_datetime(dataframe['dateTime'])
     return dataframe
 
 
@@ -119,12 +281,5 @@ def convert_dateTime_columns_to_datetime(dataframe):
     return dataframe
 
 
-def datapoint_date_to_date(datapoint):
-    try:
-        return date(year=int(datapoint['year']), month=int(datapoint['month']), day=1)
-    except KeyError:
-        return datapoint['dateTime']
-
-
 if __name__ == "__main__":
     main()
@@ -1,20 +1,30 @@
 #!/bin/python3
 
+import json
+import math
 import os
+import sys
 import urllib.parse
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+import numpy
 import pandas
 
-from plotting import plot_timeseries, box_plot_multiple_timeseries_by_freq, plot_multiple_timeseries_by_year, plot_stacked_bar_chart, plot_pie_chart
+# the shared API client, tracing and tiling modules are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import api_client
+import tiling
+import tracing
+from plotting import PLOT_OUTPUT, plot_timeseries, box_plot_multiple_timeseries_by_freq, plot_multiple_timeseries_by_year, plot_stacked_bar_chart, plot_pie_chart, render_per_field
 
 API_KEY = os.environ.get("API_KEY") or exit('API_KEY environment variable required')
 
 BASE_URL = 'https://api.agrimetrics.co.uk/field-search?'
 
 SEARCH_SHAPE_POLYGON = """geo.intersects(Location, geography'SRID=0;MultiLineString((-0.35791397094726557 51.80370566913594,-0.3737926483154297 51.81853742720025,-0.38396358489990234 51.8139477982038,-0.3879976272583008 51.802246108975304,-0.36383628845214844 51.79999033214456,-0.35791397094726557 51.80370566913594))'"""
-SEARCH_SHAPE_CIRCLE = """geo.distance(Field/centroid,geography'SRID=0;Point(-0.363389293 51.801963734)') lt 3500"""
+SEARCH_CENTRE = (-0.363389293, 51.801963734) # (lon, lat)
+SEARCH_RADIUS = 3500 # meters
 
 SEARCH_FILTER_PROPERTIES = """(Field/hasSownCrop/any(c: c/harvestYear eq 2018 and c/label eq 'Wheat'))"""
 SEARCH_SELECT_PROPERTIES = [
@@ -25,32 +35,32 @@ SEARCH_SELECT_PROPERTIES = [
     "Field/hasMonthlyTotalRainfall"
 ]
 
+# Search results are paged through with the OData $top and $skip options.
+# After the first page, up to SEARCH_WORKERS further pages are fetched at once.
+SEARCH_PAGE_SIZE = 100
+SEARCH_WORKERS = 4
 
-def main():
-    search_url = generate_search_query(shape=SEARCH_SHAPE_CIRCLE, filter=SEARCH_FILTER_PROPERTIES, select=SEARCH_SELECT_PROPERTIES)
-    print(f'Field Search URL: {search_url}\n')
-
-    search_results = get_data(search_url)
-    print(f"Found {search_results['totalResults']} fields.")
+# Number of fields whose rainfall and soil are shown by main
+SHOWN_FIELDS = 10
 
-    first_10 = search_results['results'][:10]
 
-    process_rainfall_data(first_10)
-    process_soil_data(first_10)
+def main():
+    # only the first page is fetched, as only its fields are shown; use
+    # fetch_all_search_results_for_circle to fetch every matching field
+    url = generate_search_query(shape=circle_shape(SEARCH_CENTRE, SEARCH_RADIUS), filter=SEARCH_FILTER_PROPERTIES, select=SEARCH_SELECT_PROPERTIES)
+    first_page = get_data(search_page_url(url, SHOWN_FIELDS, 0))
+    print(f"Found {first_page['totalResults']} fields.")
 
+    shown = first_page['results']
 
-def process_rainfall_data(data):
+    process_rainfall_data(shown)
+    process_soil_data(shown)
 
-    dataseries = []
 
-    # take first 10 results
-    for i, result in enumerate(data):
-        field_data = json_to_dataframe(result['hasMonthlyTotalRainfall']['hasDatapoint'])
-        field_data = convert_year_month_columns_to_date(field_data)
-        field_data["resultIndex"] = i
-        dataseries.append(field_data)
+@tracing.traced
+def process_rainfall_data(data):
 
-    all_fields_data = pandas.concat(dataseries)
+    all_fields_data = monthly_rainfall_to_dataframe(data)
 
     # plot series for all fields
     box_plot_multiple_timeseries_by_freq(all_fields_data, ['month', 'year'], labels=['Monthly', 'Yearly'], title='Rainfall')
@@ -60,12 +70,17 @@ def process_rainfall_data(data):
     monthly_rainfall_for_first_field = all_fields_data[all_fields_data.resultIndex == 0]
     plot_timeseries(monthly_rainfall_for_first_field, title='3 years of rainfall for first field')
 
+    # when writing charts to files, also write a chart of every field's rainfall
+    if PLOT_OUTPUT:
+        render_per_field(plot_timeseries, all_fields_data, os.path.join(PLOT_OUTPUT, 'rainfall'), title='Rainfall for field {key}')
+
     # pretty print first field
     monthly_rainfall_for_first_field = monthly_rainfall_for_first_field[['year', 'month', 'value']].copy()
     print('\nMonthly rainfall for first field')
     print(monthly_rainfall_for_first_field.to_string(index=False))
 
 
+@tracing.traced
 def process_soil_data(data):
     soil_data = []
 
@@ -89,11 +104,12 @@ def process_soil_data(data):
         title="Soil composition by field"
     )
 
-    df = pandas.DataFrame(top_soil_data['hasSoilTexture.hasSoilTextureType'].value_counts())
+    # the counts are used as a Series, as pandas 2 renamed the Series value_counts returns
+    soil_type_counts = top_soil_data['hasSoilTexture.hasSoilTextureType'].value_counts()
 
     plot_pie_chart(
-        data=df['hasSoilTexture.hasSoilTextureType'],
-        labels=[soil_url_to_name(url) for url in df.index],
+        data=soil_type_counts,
+        labels=[soil_url_to_name(url) for url in soil_type_counts.index],
         title='Fields by top soil type'
     )
 
@@ -113,17 +129,151 @@ def process_soil_data(data):
     print(pretty_data.to_string(index=False))
 
 
+@tracing.traced
+def monthly_rainfall_to_dataframe(results):
+    # Decode the monthly rainfall datapoints of every result into a single
+    # DataFrame, with a resultIndex column giving the position of the result
+    # each row came from. Only the columns are kept from each result, rather
+    # than building (and then concatenating) a DataFrame per field, and the
+    # results are read in one pass so they can be streamed (see stream_search_results).
+    values = []
+    years = []
+    months = []
+    result_indexes = []
+
+    for i, result in enumerate(results):
+        field_datapoints = result['hasMonthlyTotalRainfall']['hasDatapoint']
+        values.append(numpy.array([datapoint['value'] for datapoint in field_datapoints], dtype='float64'))
+        years.append(numpy.array([datapoint['year'] for datapoint in field_datapoints], dtype='int64'))
+        months.append(numpy.array([datapoint['month'] for datapoint in field_datapoints], dtype='int64'))
+        result_indexes.append(numpy.full(len(field_datapoints), i, dtype='int64'))
+
+    dataframe = pandas.DataFrame({
+        'year': concatenate(years, dtype='int64'),
+        'month': concatenate(months, dtype='int64'),
+        'value': concatenate(values, dtype='float64'),
+        'resultIndex': concatenate(result_indexes, dtype='int64'),
+    })
+    return convert_year_month_columns_to_date(dataframe)
+
+
+def concatenate(arrays, dtype):
+    return numpy.concatenate(arrays) if arrays else numpy.empty(0, dtype=dtype)
+
+
 def soil_url_to_name(url):
     return url.split("/")[-1]
 
 
+@tracing.traced
 def get_data(url):
     headers = {
       'Ocp-Apim-Subscription-Key': API_KEY
     }
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return api_client.get_json(url=url, headers=headers)
+
+
+# Like get_data, but yields the search results one at a time as they are
+# decoded from the response, so that very large responses (e.g. selecting
+# rainfall and soil layers for many fields) need not be held in memory.
+# The other members of the response, such as totalResults, are available
+# from the returned stream's `members` once the results have been read.
+def stream_data(url):
+    headers = {
+      'Ocp-Apim-Subscription-Key': API_KEY
+    }
+    return api_client.stream_json_array("GET", url=url, path=("results",), headers=headers)
+
+
+# get all pages of search results, in order.
+# The first page tells us totalResults, from which the remaining pages
+# are planned and then fetched concurrently.
+def fetch_all_search_results(url, pageSize=SEARCH_PAGE_SIZE, workers=SEARCH_WORKERS):
+    return list(iter_search_results(url, pageSize=pageSize, workers=workers))
+
+
+@tracing.traced(count="results")
+def iter_search_results(url, pageSize=SEARCH_PAGE_SIZE, workers=SEARCH_WORKERS):
+    first_page = get_data(search_page_url(url, pageSize, 0))
+    yield from first_page['results']
+
+    pages = math.ceil(first_page['totalResults'] / pageSize)
+    if pages <= 1:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+
+    def request_page(pageNum):
+        pageUrl = search_page_url(url, pageSize, pageNum * pageSize)
+        print(f"\tPage {pageNum + 1} of {pages} URL: {pageUrl}")
+        pending[pageNum] = executor.submit(get_data, pageUrl)
+
+    try:
+        for pageNum in range(1, min(pages, workers + 1)):
+            request_page(pageNum)
+
+        for pageNum in range(1, pages):
+            page = pending.pop(pageNum).result()
+            if pageNum + workers < pages:
+                request_page(pageNum + workers)
+            yield from page['results']
+    finally:
+        for future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+# Like iter_search_results, but the pages are fetched one after another and
+# streamed (see stream_data), so that only the result being processed is
+# held in memory, however many fields and properties are selected.
+@tracing.traced(count="results")
+def stream_search_results(url, pageSize=SEARCH_PAGE_SIZE):
+    skip = 0
+    while True:
+        page = stream_data(search_page_url(url, pageSize, skip))
+        count = 0
+        for result in page:
+            count += 1
+            yield result
+
+        skip += count
+        if count < pageSize or skip >= page.members.get('totalResults', math.inf):
+            return
+
+
+# get all search results for fields whose centroid lies within `radius`
+# meters of `centre`. The circle is split into tiles (see tiling.py) which
+# are searched in parallel, each restricted to the fields whose centroid
+# also lies within the tile's cell. Every field is found by exactly one
+# tile, save for centroids on the edge between two cells, which are merged.
+def fetch_all_search_results_for_circle(centre, radius, filter, select, tile_size=tiling.TILE_SIZE):
+    circle = circle_shape(centre, radius)
+    tiles = tiling.circle_tiles(centre[0], centre[1], radius, tile_size=tile_size)
+    print(f"\tSearching {len(tiles)} tiles")
+
+    def fetch_tile(tile):
+        cell = f"geo.intersects(Field/centroid,geography'SRID=0;{tiling.wkt_polygon(tiling.box_ring(tile.box))}')"
+        url = generate_search_query(shape=f"{circle} and {cell}", filter=filter, select=select)
+        print(f"\tTile URL: {url}")
+        return list(iter_search_results(url, workers=1))
+
+    return tiling.fetch_tiles(tiles, fetch_tile, key=search_result_key)
+
+
+# the fields whose centroid lies within `radius` meters of `centre` (lon, lat)
+def circle_shape(centre, radius):
+    return f"geo.distance(Field/centroid,geography'SRID=0;Point({centre[0]} {centre[1]})') lt {radius}"
+
+
+# Results only carry an id if one is selected; without one, a field found
+# by two tiles is recognised by its (identical) selected properties.
+def search_result_key(result):
+    return result.get('@id') or result.get('id') or json.dumps(result, sort_keys=True)
+
+
+def search_page_url(url, pageSize, skip):
+    return f"{url}&$top={pageSize}&$skip={skip}"
 
 
 def generate_search_query(shape, filter, select):
@@ -139,21 +289,22 @@ def generate_search_query(shape, filter, select):
 
 
 def json_to_dataframe(data):
-    return pandas.io.json.json_normalize(data)
+    return pandas.json_normalize(data)
 
 
 def convert_year_month_columns_to_date(dataframe):
-    dataframe.index = pandas.to_datetime(dataframe.apply(lambda x: datapoint_date_to_date(x), axis=1))
+    # index by the first day of each datapoint's month, built from the whole
+    # year and month columns at once; datapoints without them have a dateTime
+    if 'year' in dataframe.columns and 'month' in dataframe.columns:
+        years = dataframe['year'].astype('int64').to_numpy()
+        months = dataframe['month'].astype('int64').to_numpy()
+        months_since_epoch = (years - 1970) * 12 + (months - 1)
+        dataframe.index = pandas.DatetimeIndex(months_since_epoch.astype('datetime64[M]').astype('datetime64[ns]'))
+    else:
+        dataframe.index = pandas.to_datetime(dataframe['dateTime'])
     return dataframe
 
 
-def datapoint_date_to_date(datapoint):
-    try:
-        return date(year=int(datapoint['year']), month=int(datapoint['month']), day=1)
-    except KeyError:
-        return datapoint['dateTime']
-
-
 if __name__ == "__main__":
     main()
 
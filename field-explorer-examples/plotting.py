@@ -1,8 +1,22 @@
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date
 
 import numpy
 import pandas
 
+import matplotlib
+
+# Charts are shown interactively, unless PLOT_OUTPUT names a directory, in
+# which case each chart is written there as a PLOT_FORMAT (png or svg) file
+# instead, rendered headless with the Agg backend.
+PLOT_OUTPUT = os.environ.get("PLOT_OUTPUT")
+PLOT_FORMAT = os.environ.get("PLOT_FORMAT", "png")
+
+if PLOT_OUTPUT:
+    matplotlib.use("Agg")
+
 import matplotlib.pyplot as plt
 
 
@@ -10,7 +24,7 @@ if __name__ == "__main__":
     print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
 
 
-def plot_stacked_bar_chart(data, x, y, labels, title="Stacked bar chart"):
+def plot_stacked_bar_chart(data, x, y, labels, title="Stacked bar chart", output=None):
     fig = plt.figure()
     ax = plt.subplot(111)
     data.plot(x=x, y=y, kind='bar', stacked=True, ax=ax)
@@ -22,10 +36,10 @@ def plot_stacked_bar_chart(data, x, y, labels, title="Stacked bar chart"):
 
     fig.suptitle(title)
 
-    plt.show()
+    show(fig, title, output)
 
 
-def plot_pie_chart(data, labels, title="Pie chart"):
+def plot_pie_chart(data, labels, title="Pie chart", output=None):
     fig, ax = plt.subplots()
 
     ax.pie(
@@ -42,17 +56,18 @@ def plot_pie_chart(data, labels, title="Pie chart"):
 
     fig.suptitle(title)
 
-    plt.show()
+    show(fig, title, output)
 
 
-def plot_multiple_timeseries_by_year(data, title="Multiple timeseries by year"):
-    result_num = data.resultIndex.unique()
-    fig, axs = plt.subplots(len(result_num), sharex=True)
+def plot_multiple_timeseries_by_year(data, title="Multiple timeseries by year", output=None):
+    # split the data by result in one pass, rather than filtering it once per result
+    results = data.groupby('resultIndex', sort=False)
+    fig, axs = plt.subplots(results.ngroups, sharex=True, squeeze=False)
+    axs = axs[:, 0]
 
     ticklabels = get_monthly_ticks_for_series(data.index.month.unique())
 
-    for i, result in enumerate(result_num):
-        result_data = data[data.resultIndex == result]
+    for i, (_, result_data) in enumerate(results):
         pt = pandas.pivot_table(
             result_data,
             index=result_data.index.month,
@@ -71,10 +86,10 @@ def plot_multiple_timeseries_by_year(data, title="Multiple timeseries by year"):
 
     fig.suptitle(title)
 
-    plt.show()
+    show(fig, title, output)
 
 
-def box_plot_multiple_timeseries_by_freq(data, frequencies, labels=[], title="Box plot"):
+def box_plot_multiple_timeseries_by_freq(data, frequencies, labels=[], title="Box plot", output=None):
     # horizontal plots
     fig, axs = plt.subplots(1, len(frequencies))
 
@@ -86,17 +101,63 @@ def box_plot_multiple_timeseries_by_freq(data, frequencies, labels=[], title="Bo
 
     fig.suptitle(title)
 
-    plt.show()
+    show(fig, title, output)
 
 
-def plot_timeseries(data, title="Timeseries"):
+def plot_timeseries(data, title="Timeseries", output=None):
     fig, ax = plt.subplots()
 
     data.plot(y='value', kind='line', stacked=False, ax=ax, legend=False)
     fig.suptitle(title)
 
     standardise_plot_layout(ax)
-    plt.show()
+    show(fig, title, output)
+
+
+def show(fig, title, output=None):
+    # write the chart to `output`, or to PLOT_OUTPUT if set, or else show it
+    if output is None and PLOT_OUTPUT:
+        output = os.path.join(PLOT_OUTPUT, f"{file_name(title)}.{PLOT_FORMAT}")
+
+    if output:
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        fig.savefig(output)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def file_name(title):
+    return re.sub(r'[^A-Za-z0-9]+', '_', str(title)).strip('_').lower() or 'chart'
+
+
+# Render one chart per field (or other group) of `data` to files in
+# `directory`, named after each group's key. The data is split by `by` in a
+# single groupby pass, and the charts are drawn in parallel by a pool of
+# processes, each rendering headless with the Agg backend. `plot` is one of
+# the functions above; `title` may include the group's {key}.
+def render_per_field(plot, data, directory, by='resultIndex', title='{key}', format=PLOT_FORMAT, processes=None, **kwargs):
+    os.makedirs(directory, exist_ok=True)
+
+    tasks = [
+        (plot, group, title.format(key=key), os.path.join(directory, f"{file_name(key)}.{format}"), kwargs)
+        for key, group in data.groupby(by, sort=False)
+    ]
+
+    with ProcessPoolExecutor(max_workers=processes, initializer=use_headless_backend) as executor:
+        # send the charts to the workers in batches, to cut the cost of handing each one over
+        chunksize = max(1, len(tasks) // (4 * (processes or os.cpu_count() or 1)))
+        return list(executor.map(render_chart, tasks, chunksize=chunksize))
+
+
+def use_headless_backend():
+    plt.switch_backend('Agg')
+
+
+def render_chart(task):
+    plot, data, title, output, kwargs = task
+    plot(data, title=title, output=output, **kwargs)
+    return output
 
 
 def get_monthly_ticks_for_series(data):
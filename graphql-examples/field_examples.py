@@ -1,12 +1,24 @@
 #!/bin/python3
 
+import asyncio
 from datetime import datetime
 import json
+import math
+import os
+import sys
 
-from graphql_utils import get_paged_data, get_data
+# the shared API client, tracing and tiling modules are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+from graphql_utils import get_paged_data, get_data, get_paged_data_async, batch_loader
+import tiling
+import tracing
+from weather_store import WeatherStore
 
 POINT_LOCATION = {"type": "Point", "coordinates": [-0.363389293, 51.801963734]}
 
+LARGE_AREA_RADIUS = 10000
+
 POLYGON_LOCATION = {
     "type": "Polygon",
     "coordinates": [
@@ -41,10 +53,15 @@ POLYGON_LOCATION = {
 
 FIELD_ID = 'agfd:C6BgTxUxhMG_OCGrLGW8qw'
 
+# Directory of the local weather store used by query_rainfall_incrementally_for_fields.
+WEATHER_STORE = os.environ.get("WEATHER_STORE", "weather_store")
+
 
 def pretty_print(fun, indent=2):
     print(f"{fun.__name__}:")
-    data = fun()
+    # each example is timed as a stage (see tracing.py)
+    with tracing.span(fun.__name__):
+        data = fun()
     if data:
         print(json.dumps(data, indent=indent))
         try:
@@ -186,31 +203,53 @@ def query_ids_for_large_area():
     """
     Get the ids of all fields that lie within a 10000m radius of the default point location.
 
-    Note that this example uses a cursor to page through all the results.
+    Note that this example uses a cursor to page through all the results. Rather than paging
+    through one query over the whole area, the circle is split into smaller circular tiles
+    (see tiling.py) which are paged through in parallel. Fields are matched by their centroid,
+    so the fields found by each tile are narrowed down to those whose centroid lies within the
+    original circle, and fields found by more than one tile are merged.
     """
+    lon, lat = POINT_LOCATION["coordinates"]
+    tiles = tiling.circle_tiles(lon, lat, LARGE_AREA_RADIUS)
+
+    def within_large_area(field):
+        centroid_lon, centroid_lat = field["location"]["centroid"]["coordinates"]
+        return tiling.haversine_distance(lon, lat, centroid_lon, centroid_lat) <= LARGE_AREA_RADIUS
+
+    fields = tiling.fetch_tiles(tiles, get_field_ids_for_circle, keep=within_large_area)
+
+    return {"data": {"fields": [{"id": field["id"]} for field in fields]}}
+
+
+def get_field_ids_for_circle(tile):
     query = {
-        "query": """query LargeSearchArea($location: LocationFilter!, $cursor: String) {
-            fields(geoFilter: {location: $location, distance: {LE: 10000}}, after: $cursor) {
+        "query": f"""query LargeSearchAreaTile($location: LocationFilter!, $first: Int, $cursor: String) {{
+            fields(geoFilter: {{location: $location, distance: {{LE: {math.ceil(tile.radius)}}}}}, first: $first, after: $cursor) {{
                 id
                 cursor
-            }
-        }""",
-        "variables": {"location": POINT_LOCATION, "cursor": None},
-        "OperationName": "LargeSearchArea",
+                location {{
+                    centroid
+                }}
+            }}
+        }}""",
+        "variables": {"location": {"type": "Point", "coordinates": [tile.lon, tile.lat]}, "cursor": None},
+        "OperationName": "LargeSearchAreaTile",
     }
 
     fields = []
     for result in get_paged_field_data(query):
         fields.extend(result)
 
-    return {"data": {"fields": fields}}
+    return fields
 
 
 def query_historic_rainfall_for_fields():
     """
     Get the historic rainfall for all fields that lie within a 1000m radius of the default point location.
 
-    Note that this example uses a cursor to page through all the rainfall data results.
+    Note that this example uses a cursor to page through all the rainfall data results. The rainfall
+    for each field is retrieved concurrently, and the number of days asked for in each page grows
+    while pages come back quickly (see PageSizer in graphql_utils.py).
     """
     query = {
         "query": """query SampleFields($location: LocationFilter!) {
@@ -224,9 +263,12 @@ def query_historic_rainfall_for_fields():
 
     fields = get_data(query)
 
-    for field in fields["data"]["fields"]:
+    field_ids = [field["id"] for field in fields["data"]["fields"]]
+    rainfall = asyncio.run(get_rainfall_for_fields(field_ids, start_date="2019-05-01"))
+
+    for field, rainfall_data in zip(fields["data"]["fields"], rainfall):
         field["weatherObservations"] = {
-            "rainfallTotalDaily": get_rainfall_for_field(field["id"], start_date="2019-05-01")
+            "rainfallTotalDaily": rainfall_data
         }
 
     return fields
@@ -246,12 +288,11 @@ def get_paged_rainfall_data(query):
     )
 
 
-def get_rainfall_for_field(id, start_date):
-    query = {
-        "query": """query FieldRainfall($id: ID!, $startDate: Date!, $cursor: String) {
-            node(id: $id) {
+RAINFALL_VARIABLE_TYPES = {"id": "ID!", "startDate": "Date!", "first": "Int", "cursor": "String"}
+
+RAINFALL_SELECTION = """node(id: $id) {
                 ... on Field {
-                    weatherObservations(where: {date: {GE: $startDate}}, after: $cursor) {
+                    weatherObservations(where: {date: {GE: $startDate}}, first: $first, after: $cursor) {
                         cursor
                         rainfallTotalDaily {
                             value
@@ -259,19 +300,87 @@ def get_rainfall_for_field(id, start_date):
                         }
                     }
                 }
-            }
-        }""",
+            }"""
+
+
+def rainfall_query(id, start_date):
+    return {
+        "query": f"""query FieldRainfall($id: ID!, $startDate: Date!, $first: Int, $cursor: String) {{
+            {RAINFALL_SELECTION}
+        }}""",
         "OperationName": "FieldRainfall",
         "variables": {"id": id, "startDate": start_date},
     }
 
+
+def get_rainfall_for_field(id, start_date):
+    rainfall_data = []
+    for result in get_paged_rainfall_data(rainfall_query(id, start_date)):
+        rainfall_data.extend(result)
+
+    return rainfall_data
+
+
+async def get_rainfall_for_field_async(id, start_date, loader=None):
     rainfall_data = []
-    for result in get_paged_rainfall_data(query):
+    pages = get_paged_data_async(
+        rainfall_query(id, start_date),
+        data_extractor=extract_rainfall_total_daily,
+        cursor_extractor=extract_weather_observations_cursor,
+        loader=loader,
+    )
+    async for result in pages:
         rainfall_data.extend(result)
 
     return rainfall_data
 
 
+async def get_rainfall_for_fields(ids, start_date):
+    """
+    Get the rainfall for many fields at once. Each field's pages are fetched in order, but the
+    fields are fetched concurrently, and the concurrent requests for each round of pages are
+    batched into aliased queries (f0: node(...) f1: node(...) ...) of up to 25 fields each.
+    """
+    loader = batch_loader("FieldRainfallBatch", RAINFALL_VARIABLE_TYPES, RAINFALL_SELECTION)
+    return await asyncio.gather(*(get_rainfall_for_field_async(id, start_date, loader) for id in ids))
+
+
+def query_rainfall_incrementally_for_fields():
+    """
+    Get the historic rainfall for all fields that lie within a 1000m radius of the default point location,
+    keeping it in a local store (see weather_store.py).
+
+    The first run fetches all the rainfall since the start date. Later runs fetch only the days since the
+    last run, and append them to the store.
+    """
+    query = {
+        "query": """query SampleFields($location: LocationFilter!) {
+            fields(geoFilter: {location: $location, distance: {LE: 1000}}) {
+                id
+            }
+        }""",
+        "variables": {"location": POINT_LOCATION},
+        "OperationName": "SampleFields",
+    }
+
+    fields = get_data(query)
+    field_ids = [field["id"] for field in fields["data"]["fields"]]
+
+    store = WeatherStore(WEATHER_STORE)
+    fetched = store.refresh(field_ids, ["rainfallTotalDaily"], start_date="2019-05-01")
+    print(f"Fetched {fetched} new rainfall observations into {WEATHER_STORE}")
+
+    for field in fields["data"]["fields"]:
+        rainfall = store.read(field["id"], "rainfallTotalDaily")
+        field["weatherObservations"] = {
+            "rainfallTotalDaily": [
+                {"value": value, "dateTime": date_time.isoformat()} for date_time, value in rainfall.items()
+            ]
+        }
+
+    return fields
+
+
 def main():
     pretty_print(get_field_by_id)
     pretty_print(query_soil_by_polygon)
@@ -279,6 +388,7 @@ def main():
     pretty_print(query_daily_rainfall_for_field_for_current_month)
     pretty_print(query_ids_for_large_area)
     pretty_print(query_historic_rainfall_for_fields)
+    pretty_print(query_rainfall_incrementally_for_fields)
 
 
 if __name__ == "__main__":
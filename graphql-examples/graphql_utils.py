@@ -1,6 +1,23 @@
+import asyncio
+import contextvars
+import copy
+import functools
 import os
+import re
+import sys
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
+# the shared API client, tracing and tiling modules are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import api_client
+import tracing
+
 
 if __name__ == "__main__":
     print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
@@ -9,9 +26,46 @@ if __name__ == "__main__":
 API_KEY = os.environ.get("API_KEY") or exit('API_KEY environment variable required')
 BASE_URL = "https://api.agrimetrics.co.uk/graphql"
 
+# Maximum number of requests in flight at once from the async functions below.
+MAX_CONCURRENCY = api_client.POOL_SIZE
+
+
+# Page sizes for cursor paging. Queries which declare a $first variable
+# (without setting it) are paged with a page size tuned as they go: it
+# starts at PAGE_SIZE_START and grows while pages come back within
+# PAGE_TARGET_SECONDS and PAGE_TARGET_BYTES, shrinking when they do not. A
+# page which times out, or is refused as too large, is asked for again at
+# half the size, which then becomes the largest size tried; such pages are
+# not retried at the same size first. Other queries are paged with the
+# server's default size.
+PAGE_SIZE_MIN = 10
+PAGE_SIZE_START = 100
+PAGE_SIZE_MAX = 5000
+PAGE_TARGET_SECONDS = 2.0
+PAGE_TARGET_BYTES = 4 * 1024 ** 2
+# a page size is changed by at most this factor from one page to the next
+PAGE_SIZE_STEP = 2
+# statuses returned for responses which were too large or slow to produce
+PAGE_SIZE_STATUSES = {413, 502, 504}
+# The page size is left out of the cache key of cursor pages, as it depends
+# on the timing of the run: a rerun is answered by the pages cached before,
+# whatever their size, and follows their cursors.
+PAGE_SIZE_VARIABLES = ("first",)
+
 
 def get_data(query):
-    response = requests.post(
+    return get_sized_data(query)[0]
+
+
+@tracing.traced(name="get_data")
+def get_sized_data(query, uncached_variables=(), sized=False):
+    """
+    Like get_data, but returns (response, size of the response in bytes).
+    Variables named in uncached_variables are left out of the cache key.
+    With sized, timeouts and PAGE_SIZE_STATUSES are raised at once rather
+    than retried, so that the page can be asked for again at a smaller size.
+    """
+    return api_client.post_json(
         url=BASE_URL,
         headers={
             "accept": "application/json",
@@ -19,15 +73,83 @@ def get_data(query):
             "ocp-apim-subscription-key": API_KEY,
         },
         json=query,
+        with_size=True,
+        uncached_variables=uncached_variables,
+        no_retry_statuses=PAGE_SIZE_STATUSES if sized else (),
+        retry_timeouts=not sized,
     )
 
-    response.raise_for_status()
-    return response.json()
 
+class PageSizer:
+    """
+    Chooses the `first` variable for each page of a cursor chain. After
+    each page, the size is scaled towards the targets by the ratio of the
+    target to the time and size the page took, by at most PAGE_SIZE_STEP.
+    """
+
+    def __init__(self, size=PAGE_SIZE_START, min_size=PAGE_SIZE_MIN, max_size=PAGE_SIZE_MAX,
+                 target_seconds=PAGE_TARGET_SECONDS, target_bytes=PAGE_TARGET_BYTES):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+
+    def update(self, seconds, size=None):
+        ratios = [self.target_seconds / seconds if seconds > 0 else PAGE_SIZE_STEP]
+        if size:
+            ratios.append(self.target_bytes / size)
+        factor = min(max(min(ratios), 1 / PAGE_SIZE_STEP), PAGE_SIZE_STEP)
+        self.size = min(max(int(self.size * factor), self.min_size), self.max_size)
 
+    def shrink(self):
+        """
+        Halve the page size after a failed page, and keep it from growing
+        back, returning False if it is already as small as it can be.
+        """
+        if self.size <= self.min_size:
+            return False
+        self.size = self.max_size = max(self.size // 2, self.min_size)
+        return True
+
+
+def page_sizer(query):
+    """
+    A PageSizer for a query which declares $first and leaves it to be set,
+    otherwise None.
+    """
+    if re.search(r"\$first\b", query["query"]) and query.get("variables", {}).get("first") is None:
+        return PageSizer()
+    return None
+
+
+def is_page_size_error(error):
+    if isinstance(error, requests.Timeout):
+        return True
+    return isinstance(error, requests.HTTPError) and error.response is not None and error.response.status_code in PAGE_SIZE_STATUSES
+
+
+def get_page(query, sizer):
+    while True:
+        if sizer:
+            query["variables"]["first"] = sizer.size
+        start = time.perf_counter()
+        try:
+            response, size = get_sized_data(query, PAGE_SIZE_VARIABLES, sized=sizer is not None)
+        except requests.RequestException as e:
+            if sizer and is_page_size_error(e) and sizer.shrink():
+                continue
+            raise
+        if sizer:
+            sizer.update(time.perf_counter() - start, size)
+        return response
+
+
+@tracing.traced(count="pages")
 def get_paged_data(query, data_extractor, cursor_extractor):
+    sizer = page_sizer(query)
     while True:
-        last_response = get_data(query)
+        last_response = get_page(query, sizer)
 
         data = data_extractor(last_response)
         yield data
@@ -41,3 +163,240 @@ def get_paged_data(query, data_extractor, cursor_extractor):
             break
 
         query["variables"]["cursor"] = last_cursor
+
+
+# Async variants of the functions above. Requests are made on a thread pool
+# through the shared session, with at most MAX_CONCURRENCY in flight at once
+# across all tasks running on the event loop.
+
+_executor = None
+_executor_lock = threading.Lock()
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENCY)
+        return _executor
+
+
+def concurrency_limit():
+    loop = asyncio.get_running_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(MAX_CONCURRENCY)
+    return _semaphores[loop]
+
+
+async def get_data_async(query):
+    return (await get_sized_data_async(query))[0]
+
+
+async def get_sized_data_async(query, uncached_variables=(), sized=False):
+    response, size, _ = await get_timed_data_async(query, uncached_variables, sized)
+    return response, size
+
+
+async def get_timed_data_async(query, uncached_variables=(), sized=False):
+    """
+    Like get_sized_data_async, but returns (response, size, seconds), timing
+    only the request: not the wait for a turn under MAX_CONCURRENCY.
+    """
+    async with concurrency_limit():
+        loop = asyncio.get_running_loop()
+        # run in a copy of this task's context, so the request's spans know their parent
+        call = functools.partial(contextvars.copy_context().run, get_sized_data, query, uncached_variables, sized)
+        start = time.perf_counter()
+        response, size = await loop.run_in_executor(executor(), call)
+        return response, size, time.perf_counter() - start
+
+
+async def get_page_async(query, sizer, loader=None):
+    while True:
+        if sizer:
+            query["variables"]["first"] = sizer.size
+        try:
+            if loader:
+                # the size of one alias's part of a batched response is not known
+                (response, seconds), size = await loader.load(query), None
+            else:
+                response, size, seconds = await get_timed_data_async(query, PAGE_SIZE_VARIABLES, sized=sizer is not None)
+        except requests.RequestException as e:
+            if sizer and is_page_size_error(e) and sizer.shrink():
+                continue
+            raise
+        if sizer:
+            sizer.update(seconds, size)
+        return response
+
+
+@tracing.traced(count="pages")
+async def get_paged_data_async(query, data_extractor, cursor_extractor, loader=None):
+    """
+    Async generator yielding pages in order, like get_paged_data. The query
+    is copied, so several cursor chains can be walked concurrently from the
+    same starting query. If a loader (see batch_loader) is given, each page
+    is requested through it so that concurrent chains share requests.
+    """
+    query = copy.deepcopy(query)
+    sizer = page_sizer(query)
+    while True:
+        last_response = await get_page_async(query, sizer, loader)
+
+        data = data_extractor(last_response)
+        yield data
+
+        if not data:
+            break
+
+        last_cursor = cursor_extractor(last_response)
+
+        if last_cursor is None:
+            break
+
+        query["variables"]["cursor"] = last_cursor
+
+
+# Request batching. Rather than sending one request per object, a
+# DataLoader collects the queries made by concurrent tasks over a short
+# window and sends them as one GraphQL document, with each query's
+# selection given its own alias and its own copy of the variables.
+
+class DataLoader:
+    """
+    Collects keys requested through load() over `window` seconds (or until
+    max_batch_size keys are waiting) and resolves them all with one call to
+    batch_load, an async function taking a list of keys and returning a list
+    of values (or exceptions) in the same order.
+    """
+
+    def __init__(self, batch_load, max_batch_size=25, window=0.01):
+        self.batch_load = batch_load
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._queue = []
+        self._timer = None
+        # the event loop only keeps weak references to tasks, so the batches
+        # being loaded are kept here until they finish
+        self._tasks = set()
+
+    async def load(self, key):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((key, future))
+
+        if len(self._queue) >= self.max_batch_size:
+            self._dispatch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._dispatch)
+
+        return await future
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.ensure_future(self._load_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _load_batch(self, batch):
+        try:
+            values = await self.batch_load([key for key, _ in batch])
+        except Exception as e:
+            values = [e] * len(batch)
+
+        for (_, future), value in zip(batch, values):
+            if future.done():
+                continue
+            if isinstance(value, Exception):
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+
+def batch_loader(operation_name, variable_types, selection, **kwargs):
+    """
+    Return a DataLoader for queries made up of a single root selection, e.g.
+    `node(id: $id) { ... }`, whose variables are declared in variable_types,
+    e.g. {"id": "ID!"}. Each key is a query object; only its variables are
+    used. Each one resolves to (response, seconds the batch's request took),
+    the response shaped as though it had been sent on its own, so the usual
+    data and cursor extractors still work.
+    """
+    root_field = re.match(r"\s*(\w+)", selection).group(1)
+
+    async def batch_load(queries):
+        variables_list = [query["variables"] for query in queries]
+        # the page sizes are renamed along with the other variables
+        uncached_variables = [f"{name}{i}" for i in range(len(queries)) for name in PAGE_SIZE_VARIABLES]
+        # pages given a size are not retried at that size, as get_page_async shrinks them
+        sized = any(variables.get(name) is not None for variables in variables_list for name in PAGE_SIZE_VARIABLES)
+        response, _, seconds = await get_timed_data_async(
+            aliased_query(operation_name, variable_types, selection, variables_list),
+            uncached_variables,
+            sized,
+        )
+        return [(alias_response, seconds) for alias_response in split_aliased_response(response, len(queries), root_field)]
+
+    return DataLoader(batch_load, **kwargs)
+
+
+def aliased_query(operation_name, variable_types, selection, variables_list):
+    """
+    Build one query document containing `selection` once per set of
+    variables, aliased f0, f1, ... with the variables renamed $id0, $id1, ...
+    """
+    definitions = []
+    selections = []
+    variables = {}
+
+    for i, alias_variables in enumerate(variables_list):
+        for name, variable_type in variable_types.items():
+            definitions.append(f"${name}{i}: {variable_type}")
+            variables[f"{name}{i}"] = alias_variables.get(name)
+
+        aliased_selection = re.sub(
+            r"\$(\w+)",
+            lambda match: f"${match.group(1)}{i}" if match.group(1) in variable_types else match.group(0),
+            selection,
+        )
+        selections.append(f"f{i}: {aliased_selection}")
+
+    query_text = "query {}({}) {{\n{}\n}}".format(operation_name, ", ".join(definitions), "\n".join(selections))
+    return {
+        "query": query_text,
+        "variables": variables,
+        "operationName": operation_name,
+    }
+
+
+def split_aliased_response(response, count, root_field):
+    """
+    Split the response to an aliased_query back into one response per alias.
+    Errors are passed on to the alias named at the start of their path.
+    Errors with no path, or a path outside the aliases (e.g. a query which
+    fails validation), apply to the whole batch, so are raised.
+    """
+    data = response.get("data") or {}
+    errors = response.get("errors") or []
+
+    aliases = [f"f{i}" for i in range(count)]
+    batch_errors = [error for error in errors if (error.get("path") or [None])[0] not in aliases]
+    if batch_errors:
+        raise ValueError(f"GraphQL query errors: {batch_errors}")
+
+    responses = []
+    for alias in aliases:
+        alias_response = {"data": {root_field: data.get(alias)}}
+        alias_errors = [error for error in errors if (error.get("path") or [None])[0] == alias]
+        if alias_errors:
+            alias_response["errors"] = alias_errors
+        responses.append(alias_response)
+
+    return responses
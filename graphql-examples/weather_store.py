@@ -0,0 +1,201 @@
+import asyncio
+import os
+import urllib.parse
+
+import numpy
+import pandas
+
+from graphql_utils import get_paged_data_async, batch_loader
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# A local store of weather observation time series, so that refreshing the
+# weather for a set of fields only fetches the days since it was last
+# refreshed, rather than the whole date range again.
+#
+# Each series (one variable for one field) is kept in its own directory as
+# two append-only files of raw values: the observation times (int64 seconds
+# since the epoch) and the values (float64), in time order. The last stored
+# time is the series' high-water mark. A refresh asks the API only for
+# observations on or after the date of the mark, replaces the stored
+# observations from that date (which may have been incomplete when stored)
+# and appends the rest.
+
+TIMES_FILE = "times.i8"
+VALUES_FILE = "values.f8"
+
+WEATHER_VARIABLE_TYPES = {"id": "ID!", "startDate": "Date!", "first": "Int", "cursor": "String"}
+
+
+class WeatherStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def series_directory(self, field_id, variable):
+        return os.path.join(self.directory, urllib.parse.quote(field_id, safe=""), variable)
+
+    def read(self, field_id, variable):
+        """
+        Return a stored series as a pandas Series indexed by observation time.
+        """
+        times, values = self.arrays(field_id, variable)
+        index = pandas.DatetimeIndex(times.astype("datetime64[s]"), name="dateTime")
+        return pandas.Series(values, index=index, name=variable)
+
+    def arrays(self, field_id, variable):
+        directory = self.series_directory(field_id, variable)
+        times = read_array(os.path.join(directory, TIMES_FILE), "int64")
+        values = read_array(os.path.join(directory, VALUES_FILE), "float64")
+        # an interrupted append may have written to only one of the files
+        count = min(len(times), len(values))
+        return times[:count], values[:count]
+
+    def last_date(self, field_id, variable):
+        """
+        The date of the last stored observation (the high-water mark), or None.
+        """
+        times, _ = self.arrays(field_id, variable)
+        if not len(times):
+            return None
+        return str(times[-1].astype("datetime64[s]").astype("datetime64[D]"))
+
+    def append(self, field_id, variable, records, since=None):
+        """
+        Store records ({"dateTime": ..., "value": ...}), replacing any stored
+        observations on or after the date of the earliest. If `since` (a
+        date, as returned by last_date) is given, records before that day
+        (in UTC) are left out.
+        """
+        if not records:
+            return
+
+        times = pandas.to_datetime([record["dateTime"] for record in records], utc=True)
+        times = times.tz_localize(None).to_numpy().astype("datetime64[s]").astype("int64")
+        values = numpy.array([numpy.nan if record["value"] is None else record["value"] for record in records], dtype="float64")
+        order = numpy.argsort(times, kind="stable")
+        times, values = times[order], values[order]
+
+        if since is not None:
+            start = int(numpy.searchsorted(times, numpy.datetime64(since, "D").astype("datetime64[s]").astype("int64")))
+            times, values = times[start:], values[start:]
+            if not len(times):
+                return
+
+        directory = self.series_directory(field_id, variable)
+        os.makedirs(directory, exist_ok=True)
+
+        stored_times, _ = self.arrays(field_id, variable)
+        first_day = times[0] - times[0] % 86400
+        keep = int(numpy.searchsorted(stored_times, first_day))
+        # drops any partial append, as well as the observations being replaced
+        truncate(os.path.join(directory, TIMES_FILE), keep * 8)
+        truncate(os.path.join(directory, VALUES_FILE), keep * 8)
+
+        with open(os.path.join(directory, VALUES_FILE), "ab") as f:
+            values.tofile(f)
+        with open(os.path.join(directory, TIMES_FILE), "ab") as f:
+            times.tofile(f)
+
+    def refresh(self, field_ids, variables, start_date):
+        """
+        Bring the given variables up to date for each field, fetching only
+        observations on or after each field's high-water mark (or start_date
+        for series not yet stored). Returns the number of records fetched.
+
+        This runs its own event loop, so cannot be called where one is already
+        running, such as in a Jupyter notebook: await refresh_async there.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.refresh_async(field_ids, variables, start_date))
+        raise RuntimeError("refresh cannot be called from a running event loop; await refresh_async instead")
+
+    async def refresh_async(self, field_ids, variables, start_date):
+        """
+        Like refresh, for awaiting in a running event loop. Fields which are
+        not found are skipped.
+        """
+        selection = weather_selection(variables)
+        loader = batch_loader("WeatherRefresh", WEATHER_VARIABLE_TYPES, selection)
+
+        counts = await asyncio.gather(*(
+            self.refresh_field(field_id, variables, start_date, selection, loader)
+            for field_id in field_ids
+        ))
+        return sum(counts)
+
+    async def refresh_field(self, field_id, variables, start_date, selection, loader):
+        last_dates = [self.last_date(field_id, variable) for variable in variables]
+        field_start_date = min(date or start_date for date in last_dates)
+
+        query = {
+            "query": f"""query WeatherRefresh($id: ID!, $startDate: Date!, $first: Int, $cursor: String) {{
+                {selection}
+            }}""",
+            "variables": {"id": field_id, "startDate": field_start_date},
+        }
+
+        def extract(response):
+            if response["data"]["node"] is None:
+                print(f"\tField {field_id} not found; skipped")
+                return None
+            return extract_weather_observations(response)
+
+        records = {variable: [] for variable in variables}
+        pages = get_paged_data_async(
+            query,
+            data_extractor=extract,
+            cursor_extractor=extract_weather_observations_cursor,
+            loader=loader,
+        )
+        async for page in pages:
+            if not page:
+                continue
+            for variable in variables:
+                records[variable].extend(page.get(variable) or [])
+
+        for variable, last_date in zip(variables, last_dates):
+            # series already stored past the field's start date need only the newer records
+            self.append(field_id, variable, records[variable], since=last_date)
+
+        return sum(len(variable_records) for variable_records in records.values())
+
+
+def weather_selection(variables):
+    observations = "\n".join(f"{variable} {{ value dateTime }}" for variable in variables)
+    return f"""node(id: $id) {{
+                ... on Field {{
+                    weatherObservations(where: {{date: {{GE: $startDate}}}}, first: $first, after: $cursor) {{
+                        cursor
+                        {observations}
+                    }}
+                }}
+            }}"""
+
+
+def extract_weather_observations(response):
+    observations = dict(response["data"]["node"]["weatherObservations"])
+    observations.pop("cursor", None)
+    # an empty page ends the paging
+    return observations if any(observations.values()) else None
+
+
+def extract_weather_observations_cursor(response):
+    return response["data"]["node"]["weatherObservations"]["cursor"]
+
+
+def read_array(path, dtype):
+    if not os.path.exists(path):
+        return numpy.zeros(0, dtype=dtype)
+    data = numpy.fromfile(path, dtype="uint8")
+    # ignores a partly written value at the end of the file
+    return data[:len(data) // 8 * 8].view(dtype)
+
+
+def truncate(path, size):
+    if os.path.exists(path) and os.path.getsize(path) > size:
+        os.truncate(path, size)
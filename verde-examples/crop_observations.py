@@ -0,0 +1,221 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pandas
+
+# the shared API client, tracing and tiling modules are in ../common
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "common"))
+
+import api_client
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# Bulk retrieval of Airbus Crop Analytics crop observations for many fields.
+#
+# The field ids are split into pages of FIELDS_PER_PAGE, and each page is
+# fetched with a single query selecting every observation variable, several
+# pages at a time. The readings of each page are collected into arrays, and
+# the arrays of all the pages joined into one data frame, with one row per
+# reading and the columns:
+#
+#     field               the field id (categorical)
+#     variable            the observation variable, e.g. leafAreaIndex (categorical)
+#     date_time           the time of the reading (UTC)
+#     mean                the mean over the field (float32)
+#     standard_deviation  (float32)
+#     validity            from 0 to 1 (float32)
+#     crop_type           for the variables in CROP_TYPE_VARIABLES (categorical)
+#
+# float32 keeps about 7 significant figures, more than the precision of the
+# estimates, so a reading takes under 30 bytes, and the readings of
+# thousands of fields fit in memory. Selections, such as the readings above
+# a validity or within a few days of a date (see window_means), can then be
+# made for all fields and variables at once, with boolean masks over the
+# columns.
+#
+# The queries are made through the shared client (api_client.py), so they
+# reuse pooled connections, are retried when throttled or cut short, and
+# are answered from the response cache when API_CACHE is set.
+
+GRAPHQL_ENDPOINT = "https://api.agrimetrics.co.uk/graphql"
+
+CROP_OBSERVATION_VARIABLES = [
+    "brownVegetationCoverFraction",
+    "canopyFoliageMeanAngle",
+    "canopyHoles",
+    "canopyShadowFactor",
+    "canopyWetnessVerticalBalance",
+    "chlorophyllContent",
+    "flowerStoreyCoverFraction",
+    "fractionOfAbsorbedPhotosyntheticallyActiveRadiation",
+    "greenVegetationCoverFraction",
+    "leafAreaIndex",
+    "leafBrownIndex",
+    "leafWaterContent",
+    "normalisedDifferenceVegetationIndex",
+    "soilFraction",
+    "soilWaterSaturationFraction",
+]
+
+# Variables whose readings are for a crop type
+CROP_TYPE_VARIABLES = {"chlorophyllContent", "leafAreaIndex"}
+
+FIELDS_PER_PAGE = 20
+FETCH_WORKERS = 4
+
+COLUMNS = ["field", "variable", "date_time", "mean", "standard_deviation", "validity", "crop_type"]
+
+
+def check_results(response):
+    # GraphQL errors need not have a location, path or extensions
+    errors = response.get("errors") or []
+    if errors:
+        for err in errors:
+            print(f"{err.get('message')}:")
+            if err.get("locations"):
+                print("  at", " and ".join([f"line {loc.get('line')}, col {loc.get('column')}" for loc in err["locations"]]))
+            if err.get("path"):
+                print("  path", ".".join(str(part) for part in err["path"]))
+            if err.get("extensions"):
+                print(f"  {err['extensions']}")
+        raise Exception(f"GraphQL reported {len(errors)} errors")
+
+
+def crop_observations_query(variables):
+    selections = "\n".join(
+        f"{variable} {{ dateTime mean standardDeviation validity{' cropType' if variable in CROP_TYPE_VARIABLES else ''} }}"
+        for variable in variables
+    )
+    return f"""
+        query getCropObservations($fieldIds: [ID!]!) {{
+            fields(where: {{id: {{EQ: $fieldIds}}}}) {{
+                id
+                cropObservations {{
+                    {selections}
+                }}
+            }}
+        }}
+    """
+
+
+def fetch_crop_observations(
+    field_ids,
+    headers,
+    variables=CROP_OBSERVATION_VARIABLES,
+    fields_per_page=FIELDS_PER_PAGE,
+    workers=FETCH_WORKERS,
+    endpoint=GRAPHQL_ENDPOINT,
+):
+    """
+    Fetch the crop observations of `variables` for each of the fields, as a
+    data frame with the columns described above. The fields must have been
+    registered for crop observations. `headers` are the headers sent with
+    each query, including the API subscription key.
+    """
+    field_ids = list(dict.fromkeys(field_ids))
+    query = crop_observations_query(variables)
+    pages = [field_ids[start:start + fields_per_page] for start in range(0, len(field_ids), fields_per_page)]
+
+    def fetch_page(page):
+        response = api_client.post_json(endpoint, json={"query": query, "variables": {"fieldIds": page}}, headers=headers)
+        check_results(response)
+        return page_columns(response["data"]["fields"], variables)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        columns = list(executor.map(fetch_page, pages))
+
+    return observations_frame(columns, field_ids, variables)
+
+
+def page_columns(fields, variables):
+    """
+    Collect the readings of a page of fields into arrays: the page's field ids,
+    then for each reading the index of its field in those ids, the index of its
+    variable, and its date and time, mean, standard deviation, validity and crop
+    type.
+    """
+    page_field_ids = []
+    field_codes = []
+    variable_codes = []
+    date_times = []
+    means = []
+    standard_deviations = []
+    validities = []
+    crop_types = []
+
+    for field in fields:
+        field_code = len(page_field_ids)
+        page_field_ids.append(field["id"])
+        observations = field.get("cropObservations") or {}
+        for variable_code, variable in enumerate(variables):
+            readings = observations.get(variable) or []
+            field_codes.append(numpy.full(len(readings), field_code, dtype="int32"))
+            variable_codes.append(numpy.full(len(readings), variable_code, dtype="int8"))
+            date_times.extend(reading["dateTime"] for reading in readings)
+            means.extend(reading["mean"] for reading in readings)
+            standard_deviations.extend(reading["standardDeviation"] for reading in readings)
+            validities.extend(reading["validity"] for reading in readings)
+            crop_types.extend(reading.get("cropType") for reading in readings)
+
+    return {
+        "field_ids": page_field_ids,
+        "field": numpy.concatenate(field_codes or [numpy.empty(0, dtype="int32")]),
+        "variable": numpy.concatenate(variable_codes or [numpy.empty(0, dtype="int8")]),
+        # in UTC, as plain datetime64 values (an array of a time zone's times is of objects)
+        "date_time": pandas.to_datetime(date_times, utc=True).tz_localize(None).to_numpy(),
+        # None (a missing value) becomes NaN
+        "mean": numpy.array(means, dtype="float32"),
+        "standard_deviation": numpy.array(standard_deviations, dtype="float32"),
+        "validity": numpy.array(validities, dtype="float32"),
+        "crop_type": numpy.array(crop_types, dtype=object),
+    }
+
+
+def observations_frame(pages, field_ids, variables):
+    """
+    Join the arrays of the pages into one data frame, sorted by field,
+    variable and time.
+    """
+    # the fields of each page are numbered from 0, so are renumbered by their
+    # position in field_ids (adding any which the API named differently)
+    field_numbers = {field_id: number for number, field_id in enumerate(field_ids)}
+    fields = []
+    for page in pages:
+        numbers = numpy.array([field_numbers.setdefault(field_id, len(field_numbers)) for field_id in page["field_ids"]], dtype="int32")
+        fields.append(numbers[page["field"]])
+
+    def joined(column, dtype):
+        return numpy.concatenate([page[column] for page in pages] or [numpy.empty(0, dtype=dtype)])
+
+    frame = pandas.DataFrame({
+        "field": pandas.Categorical.from_codes(
+            numpy.concatenate(fields or [numpy.empty(0, dtype="int32")]), categories=list(field_numbers)
+        ),
+        "variable": pandas.Categorical.from_codes(joined("variable", "int8"), categories=list(variables)),
+        "date_time": pandas.DatetimeIndex(joined("date_time", "datetime64[ns]")).tz_localize("UTC"),
+        "mean": joined("mean", "float32"),
+        "standard_deviation": joined("standard_deviation", "float32"),
+        "validity": joined("validity", "float32"),
+        "crop_type": pandas.Categorical(joined("crop_type", object)),
+    })
+    frame = frame.sort_values(["field", "variable", "date_time"], kind="stable", ignore_index=True)
+    return frame[COLUMNS]
+
+
+def window_means(observations, date, days=14):
+    """
+    The mean of each field's readings of each variable taken within `days`
+    either side of `date`, as a data frame of fields by variables.
+    """
+    date = pandas.Timestamp(date)
+    if date.tzinfo is None:
+        date = date.tz_localize("UTC")
+    window = pandas.Timedelta(days=days)
+    in_window = (observations["date_time"] > date - window) & (observations["date_time"] < date + window)
+    means = observations[in_window].groupby(["field", "variable"], observed=True)["mean"].mean()
+    return means.unstack("variable")
@@ -0,0 +1,208 @@
+import numpy
+
+
+if __name__ == "__main__":
+    print("This file is a library for use by the other examples. Run on its own, it will do nothing,")
+
+
+# The evapotranspiration and soil water balance of evapotranspiration.ipynb,
+# calculated for many fields at once.
+#
+# Daily values are held in arrays with one row per field and one column per
+# day (fields x days), and per-field values (latitude, soil properties) in
+# arrays with one value per field. Reference evapotranspiration (ETo, by the
+# Hargreaves equation) and potential evapotranspiration (PET) are calculated
+# for every field and day at once. The soil water balance carries each
+# day's soil water over to the next, so it steps through the days, but
+# calculates each day for every field at once.
+#
+# The equations are those of the eto and swb packages used by the notebook,
+# so a single field gives the same results as the notebook does.
+
+# Light extinction coefficient used to scale ETo to PET by leaf area
+LAI_EXTINCTION = 0.45
+
+# Hargreaves ETo above this (mm) is treated as unrealistic, and left missing
+MAX_ETO = 15
+
+
+def extraterrestrial_radiation(latitude, day_of_year):
+    """
+    Daily extraterrestrial radiation (MJ m-2 day-1) for fields at `latitude`
+    (degrees, one per field) on each `day_of_year` (1 to 366, one per day),
+    as a fields x days array (FAO 56, equation 21).
+    """
+    phi = numpy.radians(numpy.asarray(latitude, dtype="float64"))[:, numpy.newaxis]
+    day = numpy.asarray(day_of_year, dtype="float64")[numpy.newaxis, :]
+
+    # solar declination, inverse relative distance to the sun and sunset hour angle
+    delta = 0.409 * numpy.sin(2 * numpy.pi * day / 365 - 1.39)
+    d_r = 1 + 0.033 * numpy.cos(2 * numpy.pi * day / 365)
+    w_s = numpy.arccos(-numpy.tan(phi) * numpy.tan(delta))
+
+    return 24 * 60 / numpy.pi * 0.082 * d_r * (
+        w_s * numpy.sin(phi) * numpy.sin(delta) + numpy.cos(phi) * numpy.cos(delta) * numpy.sin(w_s)
+    )
+
+
+def hargreaves_eto(t_min, t_max, t_mean, latitude, day_of_year, max_eto=MAX_ETO):
+    """
+    Reference evapotranspiration (mm) by the Hargreaves equation, from fields
+    x days arrays of daily temperatures (°C). Missing mean temperatures are
+    taken as the mean of the minimum and maximum. As in the eto package, ETo
+    is rounded to 0.01mm, negative values are taken as 0 and values above
+    `max_eto` are left missing.
+    """
+    t_min = numpy.asarray(t_min, dtype="float64")
+    t_max = numpy.asarray(t_max, dtype="float64")
+    t_mean = numpy.where(numpy.isnan(t_mean), (t_max + t_min) / 2, t_mean)
+
+    # 0.408 converts radiation in MJ m-2 day-1 to its evaporation equivalent in mm
+    eto = 0.0023 * (t_mean + 17.8) * numpy.sqrt(t_max - t_min) * extraterrestrial_radiation(latitude, day_of_year) * 0.408
+    eto = numpy.maximum(eto, 0)
+    eto[eto > max_eto] = numpy.nan
+    return numpy.round(eto, 2)
+
+
+def potential_evapotranspiration(eto, lai, extinction=LAI_EXTINCTION):
+    """
+    Scale reference evapotranspiration to the transpiring leaf area, from
+    fields x days arrays of ETo and LAI.
+    """
+    return eto * (1 - numpy.exp(-extinction * numpy.asarray(lai, dtype="float64")))
+
+
+def daily_lai(fields, dates, lai, field_count, days):
+    """
+    Interpolate LAI observations to a fields x days array.
+
+    The observations are given as three arrays: the index of each
+    observation's field (0 to field_count - 1), its date (numpy datetime64,
+    to the day) and its LAI, in any order. Observations of a field on the
+    same day are averaged, and the daily means interpolated linearly onto
+    `days`. Days before a field's first observation or after its last are
+    left missing.
+    """
+    fields = numpy.asarray(fields, dtype="int64")
+    dates = numpy.asarray(dates, dtype="datetime64[D]").astype("int64")
+    lai = numpy.asarray(lai, dtype="float64")
+    days = numpy.asarray(days, dtype="datetime64[D]").astype("int64")
+
+    # each field's observations are moved to a range of days of their own, so
+    # that every field is interpolated in one call without reaching into the
+    # observations of its neighbours
+    first_day = dates.min(initial=days.min())
+    span = dates.max(initial=days.max()) - first_day + 1
+
+    keys = fields * span + (dates - first_day)
+    unique_keys, observation = numpy.unique(keys, return_inverse=True)
+    daily_means = numpy.bincount(observation, weights=lai) / numpy.bincount(observation)
+
+    observed_fields = unique_keys // span
+    field_first = numpy.full(field_count, numpy.iinfo("int64").max)
+    field_last = numpy.full(field_count, numpy.iinfo("int64").min)
+    numpy.minimum.at(field_first, observed_fields, unique_keys)
+    numpy.maximum.at(field_last, observed_fields, unique_keys)
+
+    targets = numpy.arange(field_count)[:, numpy.newaxis] * span + (days - first_day)[numpy.newaxis, :]
+    if not len(unique_keys):
+        return numpy.full(targets.shape, numpy.nan)
+
+    result = numpy.interp(targets, unique_keys, daily_means)
+    outside = (targets < field_first[:, numpy.newaxis]) | (targets > field_last[:, numpy.newaxis])
+    result[outside] = numpy.nan
+    return result
+
+
+def soil_water_balance(
+    crop_evapotranspiration,
+    effective_precipitation,
+    theta_s,
+    theta_fc,
+    theta_wp,
+    theta_init,
+    zr=0.5,
+    zr_factor=1000,
+    p=0.5,
+    draintime=2.2,
+    mif=0.5,
+    actual_net_irrigation=0,
+):
+    """
+    The daily soil water balance of the swb package's calculate_soil_water,
+    for fields x days arrays of crop evapotranspiration, effective
+    precipitation and irrigation (mm), and the soil water contents (per
+    field, or one for all fields). The parameters are as for
+    calculate_soil_water.
+
+    Returns a dict of fields x days arrays of the root zone depletion "dr"
+    (mm), the soil water content "theta", the crop water stress factor "ks"
+    and the "recommended_net_irrigation" (mm), along with the total and
+    readily available water "taw" and "raw" (mm) of each field. As with
+    calculate_soil_water, a missing value leaves a field's balance missing
+    from that day on.
+    """
+    crop_evapotranspiration = numpy.asarray(crop_evapotranspiration, dtype="float64")
+    effective_precipitation = numpy.asarray(effective_precipitation, dtype="float64")
+    field_count, day_count = crop_evapotranspiration.shape
+    actual_net_irrigation = numpy.broadcast_to(numpy.asarray(actual_net_irrigation, dtype="float64"), (field_count, day_count))
+
+    theta_s, theta_fc, theta_wp, theta_init = (
+        numpy.broadcast_to(numpy.asarray(theta, dtype="float64"), (field_count,))
+        for theta in (theta_s, theta_fc, theta_wp, theta_init)
+    )
+
+    depth = zr * zr_factor
+    taw = (theta_fc - theta_wp) * depth
+    raw = p * taw
+    theta_fc_mm = theta_fc * depth
+
+    dr = numpy.empty((field_count, day_count))
+    theta = numpy.empty((field_count, day_count))
+    ks = numpy.empty((field_count, day_count))
+    recommended_net_irrigation = numpy.empty((field_count, day_count))
+
+    theta_prev = theta_init
+    dr_prev = (theta_fc - theta_prev) * depth
+    for day in range(day_count):
+        peff = effective_precipitation[:, day]
+
+        ks[:, day] = numpy.minimum((taw - dr_prev) / ((1 - p) * taw), 1)
+        runoff = numpy.maximum(peff + (theta_prev - theta_s) * depth, 0)
+        percolation = numpy.maximum(numpy.minimum(theta_prev, theta_s) * depth - theta_fc_mm + peff, 0) / draintime
+        dr_without_irrigation = dr_prev - (peff - runoff) + crop_evapotranspiration[:, day] * ks[:, day] + percolation
+
+        recommended_net_irrigation[:, day] = numpy.where(dr_without_irrigation > raw, dr_without_irrigation * mif, 0)
+        dr[:, day] = numpy.minimum(dr_without_irrigation - actual_net_irrigation[:, day], taw)
+        theta[:, day] = theta_fc - dr[:, day] / depth
+
+        theta_prev = theta[:, day]
+        dr_prev = dr[:, day]
+
+    return {
+        "dr": dr,
+        "theta": theta,
+        "ks": ks,
+        "recommended_net_irrigation": recommended_net_irrigation,
+        "taw": taw,
+        "raw": raw,
+    }
+
+
+def water_balance(t_min, t_max, t_mean, rainfall, lai, latitude, day_of_year, theta_s, theta_fc, theta_wp, **parameters):
+    """
+    ETo, PET and the soil water balance for many fields, from fields x days
+    arrays of weather and LAI, and the latitude and soil water contents of
+    each field. The initial soil water content is 70% of field capacity
+    unless `theta_init` is given; other parameters are passed on to
+    soil_water_balance. Returns the dict of soil_water_balance, with the
+    "eto" and "pet" arrays added.
+    """
+    eto = hargreaves_eto(t_min, t_max, t_mean, latitude, day_of_year)
+    pet = potential_evapotranspiration(eto, lai)
+    theta_init = parameters.pop("theta_init", numpy.asarray(theta_fc, dtype="float64") * 0.7)
+
+    balance = soil_water_balance(pet, rainfall, theta_s, theta_fc, theta_wp, theta_init, **parameters)
+    balance["eto"] = eto
+    balance["pet"] = pet
+    return balance